@@ -0,0 +1,40 @@
+import numpy as np
+
+
+NODATA = -9999
+
+
+class RasterAccumulator(object):
+    """
+    Running per-pixel float32 sum and valid count, so averaging many rasters
+    needs memory for one raster only. Pixels equal to the coverage nodata,
+    to NODATA or NaN are left out of both the sum and the count.
+    """
+
+    def __init__(self, nodata=NODATA):
+        self.nodata = nodata
+        self.sum = None
+        self.count = None
+
+    @property
+    def empty(self):
+        return self.sum is None
+
+    def add(self, array, nodata=None):
+        data = np.asarray(array, dtype=np.float32)
+        valid = ~np.isnan(data)
+        valid &= data != NODATA
+        if nodata is not None:
+            valid &= data != nodata
+
+        if self.sum is None:
+            self.sum = np.zeros(data.shape, dtype=np.float32)
+            self.count = np.zeros(data.shape, dtype=np.int32)
+        np.add(self.sum, data, out=self.sum, where=valid)
+        self.count += valid
+
+    def mean(self):
+        """float32 average, with self.nodata where no raster had a valid value."""
+        result = np.full(self.sum.shape, self.nodata, dtype=np.float32)
+        np.divide(self.sum, self.count, out=result, where=self.count > 0)
+        return result
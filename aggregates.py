@@ -0,0 +1,184 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+
+import numpy as np
+from affine import Affine
+
+from accumulator import NODATA, RasterAccumulator
+from metrics import count, stage
+from singleflight import host_lock
+
+
+# Root of the persisted multi-year aggregates, empty to disable them
+AGGREGATE_DIR = os.environ.get("AGGREGATE_DIR", "")
+
+
+class AggregateStore(object):
+    """
+    Per-pixel running sums and valid counts of one coverage and month over the
+    years, so the average of any set of stored years costs two reads per run of
+    consecutive years instead of downloading every year again.
+
+    Each (workspace, coverage, month) directory holds, for every stored year,
+    the prefix sum (float64) and prefix count (int32) of all stored years up to
+    and including it as .npy files read through memory maps, plus meta.json
+    with the years and the grid. Adding or replacing a year only rewrites the
+    prefixes from that year on.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self._lock = threading.Lock()
+
+    def _dir(self, workspace, coverage_id, month):
+        return os.path.join(self.root, workspace, coverage_id, f"{int(month):02d}")
+
+    def _read_meta(self, directory):
+        try:
+            with open(os.path.join(directory, "meta.json")) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write_meta(self, directory, meta):
+        self._write_atomic(directory, "meta.json", lambda f: f.write(json.dumps(meta).encode("utf-8")))
+
+    def _write_atomic(self, directory, name, write):
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".part")
+        with os.fdopen(fd, "wb") as f:
+            write(f)
+        os.replace(tmp_path, os.path.join(directory, name))
+
+    def _prefix(self, directory, year):
+        sums = np.load(os.path.join(directory, f"sum_{year:04d}.npy"), mmap_mode="r")
+        counts = np.load(os.path.join(directory, f"count_{year:04d}.npy"), mmap_mode="r")
+        return sums, counts
+
+    def _grid(self, profile):
+        return {
+            "shape": [int(profile["height"]), int(profile["width"])],
+            "transform": list(tuple(profile["transform"])[:6]),
+            "crs": profile["crs"].to_wkt() if profile.get("crs") else None,
+        }
+
+    def years(self, workspace, coverage_id, month):
+        meta = self._read_meta(self._dir(workspace, coverage_id, month))
+        return [] if meta is None else meta["years"]
+
+    def add(self, workspace, coverage_id, year, month, coverage):
+        """Store (or replace) one year of a coverage. A grid change drops the stored years."""
+        year = int(year)
+        directory = self._dir(workspace, coverage_id, month)
+        accumulator = RasterAccumulator()
+        accumulator.add(coverage.array, coverage.profile.get("nodata"))
+        year_sum = accumulator.sum.astype(np.float64)
+        year_count = accumulator.count
+        grid = self._grid(coverage.profile)
+
+        with stage("aggregate_update"), self._lock, host_lock(("aggregate", directory)):
+            meta = self._read_meta(directory)
+            if meta is not None and meta["grid"] != grid:
+                shutil.rmtree(directory, ignore_errors=True)
+                meta = None
+            if meta is None:
+                meta = {"grid": grid, "years": []}
+            os.makedirs(directory, exist_ok=True)
+
+            years = meta["years"]
+            before = [y for y in years if y < year]
+            if year in years:
+                # Replace: the change is the difference with the stored contribution
+                old_sum, old_count = self._contribution(directory, years, year)
+                delta_sum = year_sum - old_sum
+                delta_count = year_count - old_count
+            else:
+                delta_sum, delta_count = year_sum, year_count
+                if before:
+                    previous_sum, previous_count = self._prefix(directory, before[-1])
+                    new_sum, new_count = previous_sum + year_sum, previous_count + year_count
+                else:
+                    new_sum, new_count = year_sum, year_count
+                self._write_prefix(directory, year, new_sum, new_count)
+
+            for later in [y for y in years if y > year]:
+                later_sum, later_count = self._prefix(directory, later)
+                self._write_prefix(directory, later, later_sum + delta_sum, later_count + delta_count)
+            if year in years:
+                current_sum, current_count = self._prefix(directory, year)
+                self._write_prefix(directory, year, current_sum + delta_sum, current_count + delta_count)
+
+            meta["years"] = sorted(set(years) | {year})
+            meta["profile"] = {
+                "nodata": NODATA,
+                "crs": grid["crs"],
+                "transform": grid["transform"],
+                "height": grid["shape"][0],
+                "width": grid["shape"][1],
+            }
+            self._write_meta(directory, meta)
+        count("aclimate_aggregate_updates_total", {}, 1, "Years added to the aggregate store.")
+
+    def _write_prefix(self, directory, year, sums, counts):
+        sums = np.asarray(sums, dtype=np.float64)
+        counts = np.asarray(counts, dtype=np.int32)
+        self._write_atomic(directory, f"sum_{year:04d}.npy", lambda f: np.save(f, sums))
+        self._write_atomic(directory, f"count_{year:04d}.npy", lambda f: np.save(f, counts))
+
+    def _contribution(self, directory, years, year):
+        sums, counts = self._prefix(directory, year)
+        before = [y for y in years if y < year]
+        if not before:
+            return np.array(sums), np.array(counts)
+        previous_sum, previous_count = self._prefix(directory, before[-1])
+        return sums - previous_sum, counts - previous_count
+
+    def mean(self, workspace, coverage_id, month, years):
+        """
+        float32 average of the given years with NODATA where no year is valid,
+        and the profile of the grid; None unless every year is stored.
+        """
+        directory = self._dir(workspace, coverage_id, month)
+        # add() rewrites the prefixes one file at a time, they are only read as a consistent set
+        with self._lock, host_lock(("aggregate", directory)):
+            return self._mean(directory, years)
+
+    def _mean(self, directory, years):
+        meta = self._read_meta(directory)
+        years = sorted(set(int(year) for year in years))
+        if meta is None or not years or not set(years) <= set(meta["years"]):
+            count("aclimate_aggregate_queries_total", {"result": "miss"}, 1, "Aggregate store queries by result.")
+            return None
+
+        stored = meta["years"]
+        with stage("aggregate_read"):
+            total = np.zeros(meta["grid"]["shape"], dtype=np.float64)
+            valid = np.zeros(meta["grid"]["shape"], dtype=np.int32)
+            # Years consecutive in the store form a run answered by two prefixes
+            start = 0
+            while start < len(years):
+                end = start
+                while end + 1 < len(years) and stored.index(years[end + 1]) == stored.index(years[end]) + 1:
+                    end += 1
+                last_sum, last_count = self._prefix(directory, years[end])
+                total += last_sum
+                valid += last_count
+                first = stored.index(years[start])
+                if first > 0:
+                    previous_sum, previous_count = self._prefix(directory, stored[first - 1])
+                    total -= previous_sum
+                    valid -= previous_count
+                start = end + 1
+
+            result = np.full(total.shape, NODATA, dtype=np.float32)
+            np.divide(total, valid, out=result, where=valid > 0, casting="unsafe")
+
+        profile = dict(meta["profile"])
+        profile["transform"] = Affine(*profile["transform"])
+        count("aclimate_aggregate_queries_total", {"result": "hit"}, 1, "Aggregate store queries by result.")
+        return result, profile
+
+
+aggregate_store = AggregateStore(AGGREGATE_DIR) if AGGREGATE_DIR else None
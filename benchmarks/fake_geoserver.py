@@ -0,0 +1,225 @@
+"""
+Local stand-in for geo.aclimate.org used by the benchmarks.
+
+Serves synthetic GeoTIFF granules for WCS GetCoverage (Time and Long/Lat
+subsets), a grid of rectangular regions for WFS GetFeature and the part of
+the REST catalog that GeoserverClient uses.
+"""
+import json
+import re
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+from affine import Affine
+from rasterio.io import MemoryFile
+from rasterio.windows import from_bounds
+
+
+# Extent of the synthetic grid, roughly Honduras
+EXTENT = (-89.5, 12.9, -83.0, 16.5)
+
+
+class FakeGeoserver(object):
+
+    def __init__(self, width=650, height=360, regions=18, latency=0.0, last_year=2100, port=0):
+        self.width = width
+        self.height = height
+        self.regions = regions
+        self.latency = latency
+        self.last_year = last_year
+        self.stores = {}
+        self.requests = 0
+        self._granules = {}
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), self._handler())
+        self.server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address
+        return f"http://{host}:{port}/geoserver/"
+
+    @property
+    def rest_url(self):
+        return self.url + "rest/"
+
+    @property
+    def transform(self):
+        minx, miny, maxx, maxy = EXTENT
+        return Affine((maxx - minx) / self.width, 0, minx, 0, -(maxy - miny) / self.height, maxy)
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    # WCS
+
+    def granule(self, coverage_id, time_value, bbox=None):
+        key = (coverage_id, time_value, bbox)
+        with self._lock:
+            content = self._granules.get(key)
+        if content is not None:
+            return content
+
+        seed = zlib.crc32(f"{coverage_id}|{time_value}".encode("utf-8"))
+        data = np.random.default_rng(seed).uniform(0, 300, (self.height, self.width)).astype(np.float32)
+        # A nodata border like the real national grids
+        data[:, :5] = -9999
+        transform = self.transform
+        if bbox is not None:
+            window = from_bounds(*bbox, transform=transform).round_offsets().round_lengths()
+            row, col = max(int(window.row_off), 0), max(int(window.col_off), 0)
+            data = data[row:row + int(window.height), col:col + int(window.width)]
+            transform = transform * Affine.translation(col, row)
+
+        with MemoryFile() as memfile:
+            with memfile.open(driver="GTiff", width=data.shape[1], height=data.shape[0], count=1,
+                              dtype="float32", crs="EPSG:4326", transform=transform, nodata=-9999) as dataset:
+                dataset.write(data, 1)
+            content = memfile.read()
+        with self._lock:
+            self._granules[key] = content
+        return content
+
+    # WFS
+
+    def features(self):
+        minx, miny, maxx, maxy = EXTENT
+        columns = int(np.ceil(np.sqrt(self.regions)))
+        rows = int(np.ceil(self.regions / columns))
+        dx, dy = (maxx - minx) / columns, (maxy - miny) / rows
+        features = []
+        for i in range(self.regions):
+            x0 = minx + (i % columns) * dx
+            y0 = miny + (i // columns) * dy
+            features.append({
+                "type": "Feature",
+                "id": f"region.{i + 1}",
+                "geometry": {
+                    "type": "Polygon",
+                    "coordinates": [[[x0, y0], [x0 + dx, y0], [x0 + dx, y0 + dy], [x0, y0 + dy], [x0, y0]]]
+                },
+                "properties": {"ADM1_EN": f"Region {i + 1}"}
+            })
+        return features
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def log_message(self, format, *args):
+                pass
+
+            def _send(self, status, body=b"", content_type="application/xml"):
+                if isinstance(body, str):
+                    body = body.encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _read_body(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                return self.rfile.read(length) if length else b""
+
+            def _start(self):
+                with fake._lock:
+                    fake.requests += 1
+                if fake.latency:
+                    time.sleep(fake.latency)
+                return urlparse(self.path)
+
+            def do_GET(self):
+                url = self._start()
+                if "/rest/" in url.path:
+                    return self._rest_get(url.path.split("/rest/", 1)[1])
+                query = parse_qs(url.query)
+                service = query.get("service", [""])[0].upper()
+                if service == "WCS":
+                    return self._get_coverage(query)
+                if service == "WFS":
+                    return self._get_feature(query)
+                self._send(400, "unsupported request", "text/plain")
+
+            def do_PUT(self):
+                url = self._start()
+                self._read_body()
+                match = re.match(r".*/rest/workspaces/([^/]+)/coveragestores/([^/]+)/file\.imagemosaic", url.path)
+                if match:
+                    fake.stores.setdefault(match.group(1), set()).add(match.group(2))
+                    return self._send(201)
+                self._send(200)
+
+            def do_POST(self):
+                url = self._start()
+                self._read_body()
+                if url.path.endswith("file.imagemosaic"):
+                    return self._send(202)
+                self._send(201)
+
+            def do_DELETE(self):
+                self._start()
+                self._send(200)
+
+            def _get_coverage(self, query):
+                time_value = None
+                bbox = [None, None, None, None]
+                for subset in query.get("subset", []):
+                    axis, values = subset.split("(", 1)
+                    values = values.rstrip(")")
+                    if axis == "Time":
+                        time_value = values.strip('"')
+                    elif axis in ("Long", "E"):
+                        bbox[0], bbox[2] = [float(v) for v in values.split(",")]
+                    elif axis in ("Lat", "N"):
+                        bbox[1], bbox[3] = [float(v) for v in values.split(",")]
+                if time_value is None or int(time_value[:4]) > fake.last_year:
+                    return self._send(404, "<ows:ExceptionReport/>")
+                bbox = tuple(bbox) if None not in bbox else None
+                self._send(200, fake.granule(query["coverageId"][0], time_value, bbox), "image/tiff")
+
+            def _get_feature(self, query):
+                features = fake.features()
+                start = int(query.get("startIndex", ["0"])[0])
+                limit = int(query.get("maxFeatures", query.get("count", [str(len(features))]))[0])
+                page = features[start:start + limit]
+                body = {"type": "FeatureCollection", "totalFeatures": len(features),
+                        "numberReturned": len(page), "features": page}
+                self._send(200, json.dumps(body), "application/json")
+
+            def _rest_get(self, path):
+                if path == "workspaces.xml":
+                    names = set(fake.stores) | {"benchmark"}
+                    items = "".join(f"<workspace><name>{n}</name></workspace>" for n in sorted(names))
+                    return self._send(200, f"<workspaces>{items}</workspaces>")
+                match = re.match(r"workspaces/([^/]+)/(coveragestores|datastores|wmsstores)\.xml$", path)
+                if match:
+                    workspace, kind = match.groups()
+                    names = sorted(fake.stores.get(workspace, ())) if kind == "coveragestores" else []
+                    tag = {"coveragestores": "coverageStore", "datastores": "dataStore", "wmsstores": "wmsStore"}[kind]
+                    items = "".join(f"<{tag}><name>{n}</name></{tag}>" for n in names)
+                    return self._send(200, f"<{kind}>{items}</{kind}>")
+                match = re.match(r"workspaces/([^/]+)/coveragestores/([^/]+)/coverages/([^/]+)\.xml$", path)
+                if match:
+                    return self._send(200, f"<coverage><name>{match.group(3)}</name></coverage>")
+                match = re.match(r"workspaces/([^/]+)/coveragestores/([^/]+)/coverages\.json$", path)
+                if match:
+                    body = {"coverages": {"coverage": [{"name": match.group(2)}]}}
+                    return self._send(200, json.dumps(body), "application/json")
+                if path.endswith("granules.json"):
+                    return self._send(200, json.dumps({"type": "FeatureCollection", "features": []}), "application/json")
+                self._send(404, "not found", "text/plain")
+
+        return Handler
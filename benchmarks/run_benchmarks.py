@@ -0,0 +1,213 @@
+"""
+Drive the Flask endpoints against a local FakeGeoserver and report latency,
+throughput and peak RSS per scenario (on Linux; elsewhere the peak RSS is
+the peak of the whole run so far).
+
+    python benchmarks/run_benchmarks.py --latency 0.05 --output results.json
+    python benchmarks/run_benchmarks.py --compare results.json
+"""
+import argparse
+import io
+import json
+import os
+import resource
+import statistics
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, ROOT)
+
+import numpy as np
+from affine import Affine
+from rasterio.io import MemoryFile
+
+from fake_geoserver import FakeGeoserver
+
+
+USER = "benchmark"
+PASSW = "benchmark"
+WORKSPACE = "benchmark"
+
+
+def reset_peak_rss():
+    """
+    Restart the peak RSS measurement so each scenario reports its own peak.
+    Returns False where the kernel cannot (anything but Linux), peak_rss_mb
+    then falls back to the process-lifetime peak.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss_mb():
+    """Peak RSS since the last reset_peak_rss, in MB."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024.0
+    except OSError:
+        pass
+    # ru_maxrss is reported in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def upload_tiff(size):
+    data = np.random.default_rng(0).uniform(0, 300, (size, size)).astype(np.float32)
+    with MemoryFile() as memfile:
+        with memfile.open(driver="GTiff", width=size, height=size, count=1, dtype="float32",
+                          crs="EPSG:4326", transform=Affine(0.01, 0, -89.5, 0, -0.01, 16.5)) as dataset:
+            dataset.write(data, 1)
+        return memfile.read()
+
+
+def scenarios(fake, args):
+    rest_url = fake.rest_url
+    for years in args.years:
+        yield f"subtract_rasters/years={years}", "post_json", "/api/subtract_rasters", {
+            "years": list(range(2020 - years + 1, 2021)), "month": 1, "user": USER, "passw": PASSW}
+    for years in args.years:
+        yield f"subtract_rasters/average/years={years}", "post_json", "/api/subtract_rasters", {
+            "years": list(range(2020 - years + 1, 2021)), "month": 1, "user": USER, "passw": PASSW,
+            "anomalie": False}
+    yield "global_average", "post_json", "/api/global_average", {
+        "workspace": WORKSPACE, "mosaic_name": "PREC", "years": 2020, "month": 1,
+        "user": USER, "passw": PASSW}
+    for stores, dates in args.region_shapes:
+        yield f"data_region/regions={args.regions},stores={stores},dates={dates}", "post_json", "/api/data_region", {
+            "workspace": WORKSPACE, "stores": [f"store{i}" for i in range(stores)],
+            "dates": [[2020, month] for month in range(1, dates + 1)],
+            "shp_workspace": WORKSPACE, "shp_store": "regions", "user": USER, "passw": PASSW}
+    for size in args.upload_sizes:
+        yield f"import_geoserver/size={size}", "upload", "/api/import_geoserver", (
+            {"workspace": WORKSPACE, "user": USER, "passw": PASSW, "geo_url": rest_url, "store": "bench"},
+            upload_tiff(size))
+    yield "get_geo_stores", "post_json", "/api/get_geo_stores", {
+        "workspace": WORKSPACE, "user": USER, "passw": PASSW, "geo_url": rest_url}
+
+
+def call(client, kind, path, payload):
+    if kind == "post_json":
+        return client.post(path, json=payload)
+    data, content = payload
+    return client.post(path, data={"data": json.dumps(data),
+                                   "file": (io.BytesIO(content), "bench_202001.tif")},
+                       content_type="multipart/form-data")
+
+
+def reset_caches():
+    """Cold start: every cache between the endpoints and the upstream is emptied."""
+    from coverage_cache import coverage_cache
+    from regions import clear_cache
+    from result_cache import result_cache
+    from zonal_stats import clear_label_grids
+    coverage_cache.clear()
+    result_cache.clear()
+    clear_cache()
+    clear_label_grids()
+
+
+def run_scenario(app, fake, kind, path, payload, iterations, concurrency, warm=False):
+    def one(_):
+        client = app.test_client()
+        # With concurrent requests clearing would pull the caches from under the others,
+        # the caller clears them once before the scenario instead
+        if not warm and concurrency == 1:
+            reset_caches()
+        start = time.perf_counter()
+        response = call(client, kind, path, payload)
+        response.get_data()
+        return time.perf_counter() - start, response.status_code
+
+    upstream_before = fake.requests
+    per_scenario_rss = reset_peak_rss()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        samples = list(executor.map(one, range(iterations)))
+    elapsed = time.perf_counter() - start
+
+    latencies = sorted(sample[0] for sample in samples)
+    return {
+        "iterations": iterations,
+        "concurrency": concurrency,
+        "errors": sum(1 for sample in samples if sample[1] >= 400),
+        "p50_ms": statistics.median(latencies) * 1000,
+        "p95_ms": latencies[min(len(latencies) - 1, int(round(0.95 * (len(latencies) - 1))))] * 1000,
+        "throughput_rps": iterations / elapsed,
+        "upstream_requests": fake.requests - upstream_before,
+        "peak_rss_mb": peak_rss_mb(),
+        "peak_rss_scope": "scenario" if per_scenario_rss else "process",
+    }
+
+
+def write_results(path, results):
+    if path:
+        with open(path, "w") as f:
+            json.dump(results, f, indent=4)
+
+
+def compare(current, previous):
+    print(f"{'scenario':60s} {'p50 ms':>10s} {'before':>10s} {'change':>8s}")
+    for name, result in current["scenarios"].items():
+        before = previous.get("scenarios", {}).get(name)
+        if before is None:
+            continue
+        change = (result["p50_ms"] - before["p50_ms"]) / before["p50_ms"] * 100 if before["p50_ms"] else 0
+        print(f"{name:60s} {result['p50_ms']:10.1f} {before['p50_ms']:10.1f} {change:+7.1f}%")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--latency", type=float, default=0.02, help="seconds added to every upstream response")
+    parser.add_argument("--width", type=int, default=650)
+    parser.add_argument("--height", type=int, default=360)
+    parser.add_argument("--regions", type=int, default=18)
+    parser.add_argument("--years", type=int, nargs="+", default=[1, 10, 30])
+    parser.add_argument("--region-shapes", type=lambda v: tuple(int(x) for x in v.split("x")), nargs="+",
+                        default=[(3, 4)], help="STORESxDATES combinations for data_region")
+    parser.add_argument("--upload-sizes", type=int, nargs="+", default=[256, 1024])
+    parser.add_argument("--iterations", type=int, default=10)
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--warm", action="store_true",
+                        help="keep the coverage, result, region and label caches between iterations")
+    parser.add_argument("--output", help="write the results as JSON")
+    parser.add_argument("--compare", help="JSON file of a previous run to compare against")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    fake = FakeGeoserver(args.width, args.height, args.regions, args.latency).start()
+    # The service reads the GeoServer location when it is imported
+    os.environ["GEOSERVER_URL"] = fake.url
+    from main import app
+
+    results = {"started_at": time.strftime("%Y-%m-%dT%H:%M:%S"), "settings": vars(args), "scenarios": {}}
+    try:
+        for name, kind, path, payload in scenarios(fake, args):
+            if not args.warm:
+                reset_caches()
+            result = run_scenario(app, fake, kind, path, payload, args.iterations, args.concurrency, args.warm)
+            results["scenarios"][name] = result
+            # Written after every scenario so a failing one does not lose the others
+            write_results(args.output, results)
+            print(f"{name:60s} p50 {result['p50_ms']:9.1f} ms  p95 {result['p95_ms']:9.1f} ms  "
+                  f"{result['throughput_rps']:7.2f} req/s  rss {result['peak_rss_mb']:8.1f} MB  "
+                  f"errors {result['errors']}")
+    finally:
+        fake.stop()
+        write_results(args.output, results)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
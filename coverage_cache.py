@@ -0,0 +1,293 @@
+import errno
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from contextlib import contextmanager
+
+from rasterio.io import MemoryFile
+
+from metrics import count, stage
+
+
+Coverage = namedtuple("Coverage", ["array", "profile"])
+
+
+def decode_coverage(content):
+    with stage("decode"), MemoryFile(content) as memfile:
+        with memfile.open() as raster:
+            array = raster.read(1)
+            profile = raster.profile
+    # Cached arrays are shared between requests, nobody may modify them in place
+    array.setflags(write=False)
+    return Coverage(array, profile)
+
+
+@contextmanager
+def open_dataset(coverage):
+    """Open a decoded coverage as an in-memory rasterio dataset."""
+    profile = dict(coverage.profile, count=1)
+    with MemoryFile() as memfile:
+        with memfile.open(**profile) as dataset:
+            dataset.write(coverage.array, 1)
+        with memfile.open() as dataset:
+            yield dataset
+
+
+class CoverageCache(object):
+    """
+    Two tier cache for WCS GetCoverage responses.
+
+    The memory tier keeps decoded arrays and profiles in an LRU bounded by
+    array size. The disk tier keeps the raw GeoTIFF bytes, bounded by total
+    size and evicted by last access. Entries older than ttl seconds are
+    revalidated against GeoServer with their ETag before being reused.
+
+    Keys are (scope, resource) pairs. The scope identifies the GeoServer host
+    and credentials the data was fetched with, so a hit is only served to
+    callers GeoServer already authorised for it.
+    """
+
+    def __init__(self, max_memory_bytes, cache_dir=None, max_disk_bytes=0, ttl=86400):
+        self.max_memory_bytes = max_memory_bytes
+        self.cache_dir = cache_dir if max_disk_bytes > 0 else None
+        self.max_disk_bytes = max_disk_bytes
+        self.ttl = ttl
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        self._lock = threading.Lock()
+        self.counters = {"memory_hits": 0, "disk_hits": 0, "revalidated": 0, "misses": 0}
+        if self.cache_dir:
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+    def get(self, key, url, fetch):
+        """
+        Return the Coverage for key, or None when GeoServer answers 404.
+        fetch(url, headers) must perform the HTTP GET and return the response.
+        """
+        entry = self._memory_get(key)
+        if entry is None:
+            entry = self._disk_get(key)
+            if entry is not None and self._is_fresh(entry):
+                self._count("disk_hits")
+                self._memory_put(key, entry)
+                return entry["coverage"]
+        elif self._is_fresh(entry):
+            self._count("memory_hits")
+            return entry["coverage"]
+
+        headers = {}
+        if entry is not None and entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        response = fetch(url, headers)
+
+        if response.status_code == 304 and entry is not None:
+            self._count("revalidated")
+            entry["fetched_at"] = time.time()
+            self._memory_put(key, entry)
+            self._disk_touch(key, entry)
+            return entry["coverage"]
+
+        self._count("misses")
+        if response.status_code == 404:
+            return None
+
+        coverage = decode_coverage(response.content)
+        if response.status_code == 200:
+            entry = {
+                "coverage": coverage,
+                "etag": response.headers.get("ETag"),
+                "fetched_at": time.time(),
+            }
+            self._memory_put(key, entry)
+            self._disk_put(key, entry, response.content)
+        return coverage
+
+    def peek(self, key):
+        """Coverage for key when the memory tier holds a fresh copy, None otherwise."""
+        entry = self._memory_get(key)
+        if entry is None or not self._is_fresh(entry):
+            return None
+        self._count("memory_hits")
+        return entry["coverage"]
+
+    def cached_file(self, key, destination):
+        """
+        Hard link (or copy, across file systems) the GeoTIFF for key to
+        destination when the disk tier holds a fresh copy. The caller's file
+        outlives an eviction or invalidation of the entry. True on a hit.
+        """
+        if not self.cache_dir:
+            return False
+        tif_path, meta_path = self._paths(key)
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+            if time.time() - meta.get("fetched_at", 0) >= self.ttl:
+                return False
+            os.utime(tif_path)
+            try:
+                os.link(tif_path, destination)
+            except OSError as e:
+                if e.errno != errno.EXDEV:
+                    raise
+                shutil.copyfile(tif_path, destination)
+        except (OSError, ValueError):
+            return False
+        self._count("disk_hits")
+        return True
+
+    def invalidate(self, resource):
+        """Forget resource for every scope in both tiers, e.g. after its granule was replaced."""
+        with self._lock:
+            for key in [key for key in self._memory if key[1] == resource]:
+                entry = self._memory.pop(key)
+                self._memory_bytes -= entry["coverage"].array.nbytes
+        resource = json.loads(json.dumps(resource))
+        for tif_path, _, _ in self._disk_files():
+            try:
+                with open(tif_path[:-4] + ".json") as f:
+                    meta = json.load(f)
+            except (OSError, ValueError):
+                continue
+            if meta.get("resource") == resource:
+                self._remove(tif_path)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+            stats["memory_entries"] = len(self._memory)
+            stats["memory_bytes"] = self._memory_bytes
+        stats["disk_bytes"] = sum(size for _, size, _ in self._disk_files())
+        return stats
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            self._memory_bytes = 0
+        for path, _, _ in self._disk_files():
+            self._remove(path)
+
+    def _count(self, name):
+        with self._lock:
+            self.counters[name] += 1
+        count("aclimate_coverage_cache_total", {"result": name}, 1, "Coverage cache lookups by result.")
+
+    def _is_fresh(self, entry):
+        return time.time() - entry["fetched_at"] < self.ttl
+
+    # Memory tier
+
+    def _memory_get(self, key):
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                self._memory.move_to_end(key)
+            return entry
+
+    def _memory_put(self, key, entry):
+        nbytes = entry["coverage"].array.nbytes
+        if nbytes > self.max_memory_bytes:
+            return
+        with self._lock:
+            previous = self._memory.pop(key, None)
+            if previous is not None:
+                self._memory_bytes -= previous["coverage"].array.nbytes
+            self._memory[key] = entry
+            self._memory_bytes += nbytes
+            while self._memory_bytes > self.max_memory_bytes:
+                _, evicted = self._memory.popitem(last=False)
+                self._memory_bytes -= evicted["coverage"].array.nbytes
+
+    # Disk tier
+
+    def _paths(self, key):
+        name = hashlib.sha256(repr(key).encode("utf-8")).hexdigest()
+        base = os.path.join(self.cache_dir, name)
+        return base + ".tif", base + ".json"
+
+    def _disk_get(self, key):
+        if not self.cache_dir:
+            return None
+        tif_path, meta_path = self._paths(key)
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+            with open(tif_path, "rb") as f:
+                content = f.read()
+            os.utime(tif_path)
+        except (OSError, ValueError):
+            return None
+        return {
+            "coverage": decode_coverage(content),
+            "etag": meta.get("etag"),
+            "fetched_at": meta.get("fetched_at", 0),
+        }
+
+    def _disk_put(self, key, entry, content):
+        if not self.cache_dir or len(content) > self.max_disk_bytes:
+            return
+        tif_path, meta_path = self._paths(key)
+        self._write_atomic(tif_path, content)
+        self._write_meta(meta_path, key, entry)
+        self._evict_disk()
+
+    def _disk_touch(self, key, entry):
+        if not self.cache_dir:
+            return
+        tif_path, meta_path = self._paths(key)
+        if os.path.exists(tif_path):
+            self._write_meta(meta_path, key, entry)
+
+    def _write_meta(self, meta_path, key, entry):
+        meta = {"resource": key[1], "etag": entry.get("etag"), "fetched_at": entry["fetched_at"]}
+        self._write_atomic(meta_path, json.dumps(meta).encode("utf-8"))
+
+    def _write_atomic(self, path, content):
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".part")
+        with os.fdopen(fd, "wb") as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+
+    def _disk_files(self):
+        if not self.cache_dir:
+            return []
+        files = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(".tif"):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            files.append((path, stat.st_size, stat.st_mtime))
+        return files
+
+    def _evict_disk(self):
+        files = sorted(self._disk_files(), key=lambda f: f[2])
+        total = sum(size for _, size, _ in files)
+        for path, size, _ in files:
+            if total <= self.max_disk_bytes:
+                break
+            self._remove(path)
+            total -= size
+
+    def _remove(self, tif_path):
+        for path in (tif_path, tif_path[:-4] + ".json"):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+coverage_cache = CoverageCache(
+    max_memory_bytes=int(os.environ.get("COVERAGE_CACHE_MEMORY_MB", "256")) * 1024 * 1024,
+    cache_dir=os.environ.get("COVERAGE_CACHE_DIR", os.path.join(tempfile.gettempdir(), "aclimate_coverage_cache")),
+    max_disk_bytes=int(os.environ.get("COVERAGE_CACHE_DISK_MB", "2048")) * 1024 * 1024,
+    ttl=int(os.environ.get("COVERAGE_CACHE_TTL", "86400")),
+)
@@ -0,0 +1,79 @@
+import json
+
+import numpy as np
+from rasterio.features import shapes
+
+from accumulator import NODATA
+
+
+def valid_mask(array, nodata=NODATA):
+    valid = array != nodata
+    if np.issubdtype(array.dtype, np.floating):
+        valid &= np.isfinite(array)
+    return valid
+
+
+def cell_features(array, transform, nodata=NODATA, row_offset=0):
+    """One square polygon Feature per valid cell, coordinates computed in bulk."""
+    rows, cols = np.nonzero(valid_mask(array, nodata))
+    values = array[rows, cols].astype(np.float64)
+    rows = rows + row_offset
+
+    # Corners of each cell: top-left, top-right, bottom-right, bottom-left
+    x0, y0 = transform * (cols, rows)
+    x1, y1 = transform * (cols + 1, rows)
+    x2, y2 = transform * (cols + 1, rows + 1)
+    x3, y3 = transform * (cols, rows + 1)
+    corners = np.stack([x0, y0, x1, y1, x2, y2, x3, y3], axis=1).tolist()
+
+    for c, value in zip(corners, values.tolist()):
+        yield {
+            "type": "Feature",
+            "geometry": {
+                "type": "Polygon",
+                "coordinates": [[[c[0], c[1]], [c[2], c[3]], [c[4], c[5]], [c[6], c[7]], [c[0], c[1]]]]
+            },
+            "properties": {"value": value}
+        }
+
+
+def dissolved_features(array, transform, nodata=NODATA):
+    """Adjacent cells with the same value merged into one polygon."""
+    for geometry, value in shapes(array, mask=valid_mask(array, nodata), transform=transform):
+        yield {
+            "type": "Feature",
+            "geometry": geometry,
+            "properties": {"value": float(value)}
+        }
+
+
+def convert_to_geojson(array, spatial_info, nodata=NODATA, dissolve=False):
+    transform = spatial_info['transform']
+    if dissolve:
+        features = list(dissolved_features(array, transform, nodata))
+    else:
+        features = list(cell_features(array, transform, nodata))
+    return {
+        "type": "FeatureCollection",
+        "features": features
+    }
+
+
+def iter_geojson(array, transform, nodata=NODATA, dissolve=False, chunk_rows=256):
+    """
+    Encode the FeatureCollection incrementally, chunk_rows raster rows at a
+    time, so it can be streamed as a response body.
+    """
+    yield '{"type": "FeatureCollection", "features": ['
+    separator = ""
+    if dissolve:
+        chunks = [dissolved_features(array, transform, nodata)]
+    else:
+        chunks = (cell_features(array[start:start + chunk_rows], transform, nodata, start)
+                  for start in range(0, array.shape[0], chunk_rows))
+    for features in chunks:
+        encoded = [json.dumps(feature, separators=(",", ":")) for feature in features]
+        if encoded:
+            yield separator + ",".join(encoded)
+            separator = ","
+    yield ']}'
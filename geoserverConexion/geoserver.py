@@ -1,7 +1,25 @@
+import hashlib
+import json
 import os
-import sys
+import re
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from glob import glob
-from geoserverConexion.tool import GeoserverClient
+from geoserverConexion.pool import get_client
+
+
+def file_checksum(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def granule_month(filename):
+    """YYYYmm suffix of a granule file name, the time GeoServer extracts with timeregex."""
+    match = re.search(r'_(\d{6})\.tif$', filename)
+    return match.group(1) if match else None
 
 
 class GeoserverImport():
@@ -19,9 +37,13 @@ class GeoserverImport():
         os.makedirs(self.zip_path, exist_ok=True)
         self.folder_tmp = os.path.join(self.folder_root, "tmp")
         os.makedirs(self.folder_tmp, exist_ok=True)
+        self.folder_manifests = os.path.join(self.folder_root, "manifests")
+
 
+    def connect_geoserver(self, sync=False, max_workers=4):
 
-    def connect_geoserver(self):
+        if sync:
+            return self.sync_layers(max_workers)
 
         stores_aclimate = [x.split(os.sep)[-1] for x in glob(os.path.join(self.folder_layers,"*"), recursive = True)]
 
@@ -29,9 +51,7 @@ class GeoserverImport():
         try:
 
             print("Connecting")
-            geoclient = GeoserverClient(self.geo_url, self.user, self.pwd)
-            geoclient.connect()
-            geoclient.get_workspace(self.workspace)
+            geoclient = get_client(self.geo_url, self.user, self.pwd, self.workspace)
             print("Connected")
 
             for current_store in stores_aclimate:
@@ -54,12 +74,126 @@ class GeoserverImport():
             print(str(e))
             return False
 
+    def import_granules(self, store_name, granules):
+        """
+        Publish granules, a list of (file name, path or file object), into the
+        mosaic store_name. Every call builds its zip in its own temporary
+        directory, so concurrent imports never share files.
+        """
+        try:
+            with tempfile.TemporaryDirectory(prefix="geoserver_import_") as work_dir:
+                zip_file = os.path.join(work_dir, "mosaic.zip")
+
+                print("Connecting")
+                geoclient = get_client(self.geo_url, self.user, self.pwd, self.workspace)
+                print("Connected")
+
+                print("Working with", store_name)
+                geoclient.write_mosaic_zip(granules, self.folder_properties, zip_file)
+                store = geoclient.get_store(store_name)
+
+                if not store:
+                    print("Creating mosaic")
+                    geoclient.publish_mosaic(store_name, zip_file)
+                else:
+                    print("Updating mosaic")
+                    geoclient.harvest_mosaic(store, zip_file)
+
+            return True
+        except Exception as e:
+            print(str(e))
+            return False
+
+    def sync_layers(self, max_workers=4):
+        """
+        Upload only the granules of layers/ that GeoServer does not index yet
+        or that changed since they were uploaded, processing the stores in
+        parallel. Returns {store: {"uploaded", "skipped", "failed"}} counts.
+        """
+        stores_aclimate = [os.path.basename(x) for x in glob(os.path.join(self.folder_layers, "*")) if os.path.isdir(x)]
+        if not stores_aclimate:
+            return {}
+        with ThreadPoolExecutor(max_workers=max(1, min(len(stores_aclimate), max_workers))) as executor:
+            futures = {store_name: executor.submit(self.sync_store, store_name) for store_name in stores_aclimate}
+            report = {store_name: future.result() for store_name, future in futures.items()}
+        for store_name, counts in report.items():
+            print(store_name, counts)
+        return report
+
+    def sync_store(self, store_name):
+        """
+        Compare the local granules of a store with the ones its mosaic indexes,
+        by file name or time, and with the checksums of the last upload kept in
+        the store manifest. New and changed granules are sent in one harvest;
+        the previous index entries of changed ones are removed only after it
+        succeeds, so a failed harvest leaves them published. Granules indexed before
+        the manifest existed are assumed unchanged and adopted.
+        """
+        files = sorted(glob(os.path.join(self.folder_layers, store_name, "*.tif")))
+        counts = {"uploaded": 0, "skipped": 0, "failed": 0}
+        try:
+            geoclient = get_client(self.geo_url, self.user, self.pwd, self.workspace)
+            store = geoclient.get_store(store_name)
+            indexed = geoclient.list_granules(store) if store else {}
+            indexed_months = {granule_month(name): granule for name, granule in indexed.items() if granule_month(name)}
+            manifest = self._load_manifest(store_name)
+
+            upload = []
+            replace = []
+            for path in files:
+                name = os.path.basename(path)
+                checksum = file_checksum(path)
+                granule = indexed.get(name) or indexed_months.get(granule_month(name))
+                if granule is None:
+                    upload.append((name, path, checksum))
+                elif name in indexed and manifest.get(name) in (None, checksum):
+                    manifest[name] = checksum
+                    counts["skipped"] += 1
+                else:
+                    upload.append((name, path, checksum))
+                    replace.append(granule["id"])
+        except Exception as e:
+            print(store_name, str(e))
+            counts["failed"] = len(files)
+            return counts
+
+        if upload:
+            if self.import_granules(store_name, [(name, path) for name, path, _ in upload]):
+                counts["uploaded"] = len(upload)
+                for name, _, checksum in upload:
+                    manifest[name] = checksum
+                # The old index entries only go once the new granules are published
+                for granule_id in replace:
+                    try:
+                        geoclient.delete_granule(store, granule_id)
+                    except Exception as e:
+                        print(store_name, "stale granule", granule_id, "not removed:", str(e))
+            else:
+                counts["failed"] = len(upload)
+        self._save_manifest(store_name, manifest)
+        return counts
+
+    def _manifest_path(self, store_name):
+        return os.path.join(self.folder_manifests, f"{self.workspace}_{store_name}.json")
+
+    def _load_manifest(self, store_name):
+        try:
+            with open(self._manifest_path(store_name)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_manifest(self, store_name, manifest):
+        os.makedirs(self.folder_manifests, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.folder_manifests, suffix=".part")
+        with os.fdopen(fd, "w") as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self._manifest_path(store_name))
+
     
     def get_geoserver_stores(self):
         print("Connecting")
-        geoclient = GeoserverClient(self.geo_url, self.user, self.pwd)
-        geoclient.connect()
-        geoclient.get_workspace(self.workspace)
+        geoclient = get_client(self.geo_url, self.user, self.pwd, self.workspace)
 
         stores = geoclient.get_stores()
         return stores
\ No newline at end of file
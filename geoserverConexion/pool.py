@@ -0,0 +1,39 @@
+import os
+import threading
+
+from geoserverConexion.tool import GeoserverClient
+from geoserverConexion.ttl_cache import TTLCache
+
+
+LOOKUP_TTL = int(os.environ.get("GEOSERVER_LOOKUP_TTL", "60"))
+
+_pool = {}
+_pool_lock = threading.Lock()
+
+
+def get_client(url, user, pwd, workspace=None):
+    """
+    GeoserverClient sharing the process-wide Catalog (and its HTTP session)
+    and lookup memo of (url, user). Each caller gets its own client object so
+    the selected workspace is never shared between requests.
+    """
+    key = (url, user)
+    with _pool_lock:
+        entry = _pool.get(key)
+        if entry is None or entry["pwd"] != pwd:
+            client = GeoserverClient(url, user, pwd, lookups=TTLCache(LOOKUP_TTL))
+            client.connect()
+            if client.catalog is None:
+                return client
+            entry = {"pwd": pwd, "catalog": client.catalog, "lookups": client.lookups}
+            _pool[key] = entry
+
+    client = GeoserverClient(url, user, pwd, catalog=entry["catalog"], lookups=entry["lookups"])
+    if workspace:
+        client.get_workspace(workspace)
+    return client
+
+
+def clear_pool():
+    with _pool_lock:
+        _pool.clear()
@@ -6,6 +6,7 @@ import shutil
 from geoserver.catalog import Catalog
 from geoserver.resource import Coverage
 from geoserver.support import DimensionInfo
+from metrics import stage
 
 
 class GeoserverClient(object):
@@ -17,15 +18,31 @@ class GeoserverClient(object):
     workspace = None
     workspace_name = ''
 
-    def __init__(self, url, user, pwd):
+    def __init__(self, url, user, pwd, catalog=None, lookups=None):
         self.url = url
         self.user = user
         self.pwd = pwd
-        self.catalog = None
+        self.catalog = catalog
         self.workspace = None
         self.workspace_name = ''
+        # Optional TTLCache memoizing workspace/store/coverage lookups
+        self.lookups = lookups
+
+    def _lookup(self, key, loader):
+        with stage("catalog"):
+            if self.lookups is None:
+                return loader()
+            return self.lookups.get(key, loader)
+
+    def invalidate_store(self, store_name):
+        if self.lookups is not None:
+            self.lookups.invalidate(("store", self.workspace_name, store_name),
+                                    ("stores", self.workspace_name),
+                                    ("coverages", self.workspace_name, store_name))
 
     def connect(self):
+        if self.catalog:
+            return
         try:
             self.catalog = Catalog(
                 self.url, username=self.user, password=self.pwd)
@@ -36,7 +53,7 @@ class GeoserverClient(object):
 
     def get_workspace(self, name):
         if self.catalog:
-            self.workspace = self.catalog.get_workspace(name)
+            self.workspace = self._lookup(("workspace", name), lambda: self.catalog.get_workspace(name))
             self.workspace_name = name
             print("Workspace found")
         else:
@@ -55,7 +72,8 @@ class GeoserverClient(object):
                 return None
             """
             try:
-                store = self.catalog.get_store(store_name, self.workspace)
+                store = self._lookup(("store", self.workspace_name, store_name),
+                                     lambda: self.catalog.get_store(store_name, self.workspace))
                 return store
             except Exception as err:
                 print("Store not found:", store_name)
@@ -67,7 +85,8 @@ class GeoserverClient(object):
     def get_stores(self):
         if self.workspace:
             try:
-                stores = self.catalog.get_stores(self.workspace)
+                stores = self._lookup(("stores", self.workspace_name),
+                                      lambda: self.catalog.get_stores(self.workspace))
                 return stores
             except Exception as err:
                 print("Stores not found in:", self.workspace)
@@ -112,10 +131,39 @@ class GeoserverClient(object):
             print(folder_properties, os.path.exists(folder_properties))
             return None
 
+    def write_mosaic_zip(self, granules, folder_properties, zip_file):
+        """
+        Write the mosaic zip straight from its sources. granules is a list of
+        (file name, path or file object); the properties files and the rasters
+        are streamed into zip_file without intermediate copies.
+        """
+        props = glob.glob(os.path.join(folder_properties, '*.properties'))
+        if len(props) != 2:
+            raise ValueError("check the properties file")
+
+        with stage("zip"), ZipFile(zip_file, mode="w") as zip:
+            for p in props:
+                zip.write(p, p.rsplit(os.path.sep, 1)[-1])
+            for name, source in granules:
+                if isinstance(source, str):
+                    zip.write(source, name)
+                else:
+                    with zip.open(name, mode="w") as entry:
+                        shutil.copyfileobj(source, entry)
+        return zip_file
+
     def create_mosaic(self, store_name, file, folder_properties, folder_tmp, zip_path):
         output = self.zip_files(file, folder_properties, folder_tmp, zip_path)
+        self.publish_mosaic(store_name, output)
+
+    def publish_mosaic(self, store_name, output):
+        with stage("publish"):
+            self._publish_mosaic(store_name, output)
+
+    def _publish_mosaic(self, store_name, output):
         #print(output)
         self.catalog.create_imagemosaic(store_name, output, workspace=self.workspace)
+        self.invalidate_store(store_name)
         print(f"Mosaic store : {store_name} is created!")
         store = self.catalog.get_store(store_name, workspace=self.workspace)
         url = self.url + "workspaces/" + self.workspace_name + \
@@ -144,16 +192,50 @@ class GeoserverClient(object):
 
     def update_mosaic(self, store, file, folder_properties, folder_tmp, zip_path):
         output = self.zip_files(file, folder_properties, folder_tmp, zip_path)
-        self.catalog.harvest_uploadgranule(output, store)
+        self.harvest_mosaic(store, output)
+
+    def harvest_mosaic(self, store, output):
+        with stage("publish"):
+            self.catalog.harvest_uploadgranule(output, store)
+        self.invalidate_store(store.name)
         print("Mosaic updated")
 
+    def mosaic_coverage_name(self, store):
+        coverages = self._lookup(("coverages", self.workspace_name, store.name),
+                                 lambda: self.catalog.mosaic_coverages(store))
+        return (coverages[b"coverages"][b"coverage"][0][b"name"]).decode("utf-8")
+
     def check(self, store):
-        coverages = self.catalog.mosaic_coverages(store)
-        granules = self.catalog.mosaic_granules(
-            (coverages[b"coverages"][b"coverage"][0][b"name"]).decode("utf-8"), store)
+        granules = self.catalog.mosaic_granules(self.mosaic_coverage_name(store), store)
         granules_count = len(granules[b"features"])
         print("granules", granules_count)
 
+    def list_granules(self, store, page_size=1000):
+        """Granules indexed by a mosaic as {file name: {"id", "time"}}, read page by page."""
+        coverage = self.mosaic_coverage_name(store)
+        granules = {}
+        offset = 0
+        with stage("catalog"):
+            while True:
+                page = self.catalog.mosaic_granules(coverage, store, limit=page_size, offset=offset)
+                features = page.get(b"features") or []
+                for feature in features:
+                    properties = feature.get(b"properties") or {}
+                    location = (properties.get(b"location") or b"").decode("utf-8")
+                    time = properties.get(b"ingestion")
+                    granules[os.path.basename(location)] = {
+                        "id": (feature.get(b"id") or b"").decode("utf-8"),
+                        "time": time.decode("utf-8") if isinstance(time, bytes) else time,
+                    }
+                if len(features) < page_size:
+                    break
+                offset += page_size
+        return granules
+
+    def delete_granule(self, store, granule_id):
+        with stage("publish"):
+            self.catalog.mosaic_delete_granule(self.mosaic_coverage_name(store), store, granule_id)
+
     def delete_folder_content(self, folder_path):
         list_dir = os.listdir(folder_path)
         for filename in list_dir:
@@ -0,0 +1,31 @@
+import threading
+import time
+
+
+class TTLCache(object):
+    """Thread safe memo of catalog lookups, each entry lives ttl seconds."""
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._items = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, loader):
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None and time.time() - item[0] < self.ttl:
+                return item[1]
+
+        value = loader()
+        with self._lock:
+            self._items[key] = (time.time(), value)
+        return value
+
+    def invalidate(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._items.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
@@ -1,15 +1,29 @@
-import requests
 import rasterio
 import numpy as np
-from urllib.parse import urlencode
-from rasterio.io import MemoryFile
-from rasterio.mask import mask
-import geopandas as gpd
+from rasterio.transform import rowcol
 import os
 import json
-import shutil
 import re
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from zipfile import ZipFile
+from accumulator import NODATA, RasterAccumulator
+from aggregates import aggregate_store
+from coverage_cache import coverage_cache
+from result_cache import result_cache
+from geojson_output import iter_geojson
+from raster_output import output_options, write_geotiff
+from windowed import read_output, windowed_average, windowed_mean
 from geoserverConexion.geoserver import GeoserverImport 
+from raster_sources import get_coverage, spool_coverage
+from wcs import coverage_resource, download_pool
+from zonal_stats import STATISTICS, get_label_grid, zonal_stats
+from metrics import in_context, stage
+from regions import envelope, get_features, layer_key
+
+# Half size in degrees of the window requested around a time series point
+POINT_BUFFER = 0.1
+
 
 class Response:
     def __init__(self, res=None, error=None):
@@ -17,287 +31,275 @@ class Response:
         self.error = error
 
 
-def convert_to_geojson(subtraction_array, spatial_info):
-    # Obtener la transformación espacial (affine transformation) del archivo GeoTIFF
-    transform = spatial_info['transform']
-    
-    # Obtener la resolución espacial
-    x_resolution = transform.a
-    y_resolution = -transform.e  # Negativo porque la transformación mantiene el eje Y invertido
-    
-    # Obtener la esquina superior izquierda
-    x_origin = transform.c
-    y_origin = transform.f
-    
-    # Crear una lista para almacenar las geometrías y propiedades de los polígonos
-    features = []
-    
-    # Obtener la forma de la matriz de resta
-    rows, cols = subtraction_array.shape
-    
-    # Iterar sobre cada celda de la matriz de resta
-    for row in range(rows):
-        for col in range(cols):
-            # Obtener el valor de la celda
-            value = float(subtraction_array[row, col])
-            
-            # Calcular las coordenadas geográficas de la celda
-            lon = x_origin + col * x_resolution
-            lat = y_origin + row * y_resolution
-            
-            # Crear un polígono cuadrado con la esquina superior izquierda y la esquina inferior derecha de la celda
-            geometry = {
-                "type": "Polygon",
-                "coordinates": [
-                    [
-                        [lon, lat],
-                        [lon + x_resolution, lat],
-                        [lon + x_resolution, lat - y_resolution],
-                        [lon, lat - y_resolution],
-                        [lon, lat]
-                    ]
-                ]
-            }
-            
-            # Crear una propiedad con el valor de la celda
-            properties = {
-                "value": value
-            }
-            
-            # Crear una característica GeoJSON con la geometría y las propiedades
-            feature = {
-                "type": "Feature",
-                "geometry": geometry,
-                "properties": properties
-            }
-            
-            # Agregar la característica a la lista de características
-            features.append(feature)
-    
-    # Crear el objeto GeoJSON final
-    geojson = {
-        "type": "FeatureCollection",
-        "features": features
-    }
-    
-    return geojson
-
-
 def calculate_average(rasters):
-    raster_arrays = [rasterio.open(raster).read(1) for raster in rasters]
-    average = np.mean(raster_arrays, axis=0)
-    return average
+    accumulator = RasterAccumulator()
+    for raster in rasters:
+        with rasterio.open(raster) as dataset:
+            accumulator.add(dataset.read(1), dataset.nodata)
+    return accumulator.mean()
 
 def subtract_rasters(raster1, raster2):
-    # Convert rasters to NumPy arrays and ensure they are of float type to handle -9999 values correctly
-    raster1_array = np.array(raster1, dtype=np.float32)
-    raster2_array = np.array(raster2, dtype=np.float32)
+    # Work in float32; arrays that already are float32 (e.g. RasterAccumulator.mean) are not copied
+    raster1_array = np.asarray(raster1, dtype=np.float32)
+    raster2_array = np.asarray(raster2, dtype=np.float32)
 
-    # Mask -9999 values to prevent them from affecting subtraction
-    raster1_array[raster1_array == -9999] = np.nan
-    raster2_array[raster2_array == -9999] = np.nan
+    # -9999 values must not take part in the subtraction
+    nodata = (raster1_array == NODATA) | (raster2_array == NODATA)
 
     # Perform subtraction and keep values as NaN when one of the values is NaN
-    subtraction = ((raster1_array - raster2_array) / raster2_array) * 100
+    with np.errstate(invalid='ignore', divide='ignore'):
+        subtraction = ((raster1_array - raster2_array) / raster2_array) * 100
 
-    # Convert NaN values back to -9999
-    subtraction[np.isnan(subtraction)] = -9999
+    # Convert nodata, NaN and the infinities of a zero climatology back to -9999
+    subtraction[nodata | ~np.isfinite(subtraction)] = NODATA
 
     return subtraction
 
-def main(years, month, user, passw, anomalie=True):
+def main(years, month, user, passw, anomalie=True, max_workers=None, output_format="geotiff", dissolve=False, bbox=None, output=None, windowed=False):
+
+  if windowed:
+      if output_format != "geotiff":
+          return Response(error="Windowed processing only produces geotiff.")
+      return main_windowed(years, month, user, passw, anomalie, max_workers, bbox, output)
 
   try:
     spatial_info = None
-    all_raster_arrays = []
+    accumulator = RasterAccumulator()
 
-    url_root = "https://geo.aclimate.org/geoserver/"
     workspace = "historical_climate_hn"
     workspaceC = "climatology_hn"
     mosaic_name = "PREC"
-    urls = []
-
-    for year in years:
-        base_url = f"{url_root}{workspace}/ows?"
-        params = {
-            "service": "WCS",
-            "request": "GetCoverage",
-            "version": "2.0.1",
-            "coverageId": mosaic_name,
-            "format": "image/geotiff",
-            "subset": f"Time(\"{year}-{month:02d}-01T00:00:00.000Z\")"
-        }
-        url = base_url + urlencode(params)
-        urls.append(url)
-
-        response = requests.get(url, auth=(user, passw))
-        # If response is 404, nothing found, break out of loop
-        if response.status_code == 404:
-            break
-        
-        # Open response content with rasterio
-        with MemoryFile(response.content) as memfile:
-            with memfile.open() as raster:
-                raster_array = raster.read(1)
-                all_raster_arrays.append(raster_array)
-                spatial_info = raster.profile  # Get spatial info in here
-        
-    
-    if not all_raster_arrays:
-        print("No rasters found for download.")
-        return
-    
+
+    # Whole-grid averages of years already in the aggregate store are not downloaded again
+    use_aggregates = aggregate_store is not None and bbox is None
+    stored = aggregate_store.mean(workspace, mosaic_name, month, years) if use_aggregates else None
+    # The store holds no credentials: GeoServer must still grant this caller the coverage
+    if stored is not None and get_coverage(workspace, mosaic_name, years[-1], month, user, passw) is None:
+        stored = None
+    known_years = set(aggregate_store.years(workspace, mosaic_name, month)) if use_aggregates else set()
+
+    with download_pool(max_workers) as executor:
+        # All years and the climatology are requested at the same time
+        year_futures = [] if stored is not None else [executor.submit(in_context(get_coverage), workspace, mosaic_name, year, month, user, passw, bbox) for year in years]
+        climatology_future = None
+        if anomalie:
+            climatology_future = executor.submit(in_context(get_coverage), workspaceC, mosaic_name, 2000, month, user, passw, bbox)
+
+        for index, future in enumerate(year_futures):
+            coverage = future.result()
+            # Drop the reference so consumed years can be released
+            year_futures[index] = None
+            # If response is 404, nothing found, break out of loop
+            if coverage is None:
+                for pending in year_futures[index + 1:]:
+                    pending.cancel()
+                break
+
+            with stage("average"):
+                accumulator.add(coverage.array, coverage.profile.get('nodata'))
+            # Downloaded years missing from the store are added on the way
+            if use_aggregates and int(years[index]) not in known_years:
+                aggregate_store.add(workspace, mosaic_name, years[index], month, coverage)
+            spatial_info = coverage.profile  # Get spatial info in here
+            del coverage
+
+        if stored is None and accumulator.empty:
+            print("No rasters found for download.")
+            return Response(error="No rasters found for download.")
+
+        climatology_coverage = climatology_future.result() if anomalie else None
+
     # Calculate average of rasters
-    average_array = np.mean(all_raster_arrays, axis=0)
+    if stored is not None:
+        average_array, spatial_info = stored
+    else:
+        average_array = accumulator.mean()
     
     if anomalie:
-        base_url = f"{url_root}{workspaceC}/ows?"
-        params = {
-            "service": "WCS",
-            "request": "GetCoverage",
-            "version": "2.0.1",
-            "coverageId": mosaic_name,
-            "format": "image/geotiff",
-            "subset": f"Time(\"2000-{month:02d}-01T00:00:00.000Z\")"
-        }
-        url = base_url + urlencode(params)
-        urls.append(url)
-
-        responseC = requests.get(url, auth=(user, passw))
+        if climatology_coverage is None:
+            return Response(error="No climatology found for month " + str(month))
+        climatology = climatology_coverage.array
 
+        with stage("anomaly"):
+            result_array = subtract_rasters(average_array, climatology)
+    else:
+        result_array = average_array
 
-        
-        climatology = None
-
-        with MemoryFile(responseC.content) as memfile:
-                with memfile.open() as raster:
-                    raster_array = raster.read(1)
-                    climatology = raster_array
+    if output_format == "geojson":
+        # Features are encoded lazily while the response is being sent
+        return Response(res=iter_geojson(result_array, spatial_info['transform'], NODATA, dissolve))
 
+    tiff_result = write_geotiff(result_array, spatial_info['crs'], spatial_info['transform'], NODATA, output)
 
-        subtraction = subtract_rasters(average_array, climatology)
+    return Response(res=tiff_result)
 
-        
-        with MemoryFile() as memfile:
-            with memfile.open(driver='GTiff', width=subtraction.shape[1], height=subtraction.shape[0], count=1, dtype=subtraction.dtype, crs=spatial_info['crs'], transform=spatial_info['transform']) as dataset:
-                dataset.write(subtraction, 1)
-            memfile.seek(0)
-            geojson_result = memfile.read()
-        #geojson_result = convert_to_geojson(subtraction, spatial_info)
-
-        return Response(res=geojson_result)
-    else:
-        with MemoryFile() as memfile:
-            with memfile.open(driver='GTiff', width=average_array.shape[1], height=average_array.shape[0], count=1, dtype=average_array.dtype, crs=spatial_info['crs'], transform=spatial_info['transform']) as dataset:
-                dataset.write(average_array, 1)
-            memfile.seek(0)
-            geojson_result = memfile.read()
-        #geojson_result = convert_to_geojson(subtraction, spatial_info)
-
-        return Response(res=geojson_result)
-  
   except Exception as e:
       # Si ocurre un error, configura el error en el objeto Response
       return Response(error=str(e))
 
 
 
-def calculate_mean(workspace, mosaic_name, year, month, user, passw):
+def main_windowed(years, month, user, passw, anomalie=True, max_workers=None, bbox=None, output=None):
+    """
+    Same result as main, computed out of core: every coverage is spooled to a
+    file and the average/anomaly is computed and written block by block.
+    """
+    try:
+        workspace = "historical_climate_hn"
+        workspaceC = "climatology_hn"
+        mosaic_name = "PREC"
+        output = output_options(output)
+
+        with tempfile.TemporaryDirectory(prefix="windowed_") as directory:
+            with download_pool(max_workers) as executor:
+                year_futures = [executor.submit(in_context(spool_coverage), workspace, mosaic_name, year, month, user, passw, directory, bbox) for year in years]
+                climatology_future = None
+                if anomalie:
+                    climatology_future = executor.submit(in_context(spool_coverage), workspaceC, mosaic_name, 2000, month, user, passw, directory, bbox)
+
+                paths = []
+                for index, future in enumerate(year_futures):
+                    path = future.result()
+                    # If response is 404, nothing found, break out of loop
+                    if path is None:
+                        for pending in year_futures[index + 1:]:
+                            pending.cancel()
+                        break
+                    paths.append(path)
+
+                climatology_path = climatology_future.result() if anomalie else None
+
+            if not paths:
+                print("No rasters found for download.")
+                return Response(error="No rasters found for download.")
+            if anomalie and climatology_path is None:
+                return Response(error="No climatology found for month " + str(month))
+
+            output_path = os.path.join(directory, "result.tif")
+            with stage("windowed"):
+                profile = windowed_average(paths, output_path, output, climatology_path, subtract_rasters)
+            with stage("encode"):
+                return Response(res=read_output(output_path, profile, output))
+    except Exception as e:
+        return Response(error=str(e))
+
+
+def coverage_mean(coverage):
+    """Mean of the valid pixels, using the nodata value declared by the coverage (or -9999)."""
+    array = coverage.array
+    nodata = coverage.profile.get('nodata')
+    valid = array != (NODATA if nodata is None else nodata)
+    if np.issubdtype(array.dtype, np.floating):
+        valid &= ~np.isnan(array)
+    count = np.count_nonzero(valid)
+    if count == 0:
+        return None
+    return float(array.sum(where=valid, dtype=np.float64) / count)
+
+
+def calculate_mean(workspace, mosaic_name, year, month, user, passw, bbox=None, windowed=False):
     
     try:
-      url_root = "https://geo.aclimate.org/geoserver/"
-      base_url = f"{url_root}{workspace}/ows?"
-      params = {
-          "service": "WCS",
-          "request": "GetCoverage",
-          "version": "2.0.1",
-          "coverageId": mosaic_name,
-          "format": "image/geotiff",
-          "subset": f"Time(\"{year:04d}-{month:02d}-01T00:00:00.000Z\")"
-      }
-      url = base_url + urlencode(params)
-      response = requests.get(url, auth=(user, passw))
-      mean_value = None
-      with MemoryFile(response.content) as memfile:
-          with memfile.open() as dataset:
-              raster_array = dataset.read(1)
-              raster_array = raster_array.astype(np.float64)
-              masked_array = np.ma.masked_where(raster_array == np.min(raster_array), raster_array)
-              
-              mean_value = np.mean(masked_array)
+      if windowed:
+          with tempfile.TemporaryDirectory(prefix="windowed_") as directory:
+              path = spool_coverage(workspace, mosaic_name, year, month, user, passw, directory, bbox)
+              if path is None:
+                  return Response(error=f"No coverage found for {mosaic_name} on {year:04d}-{month:02d}")
+              with stage("mean"):
+                  return Response(res=windowed_mean(path))
+
+      coverage = get_coverage(workspace, mosaic_name, year, month, user, passw, bbox)
+      if coverage is None:
+          return Response(error=f"No coverage found for {mosaic_name} on {year:04d}-{month:02d}")
+
+      with stage("mean"):
+          mean_value = coverage_mean(coverage)
 
       return Response(res=mean_value)
     except Exception as e:
       # Si ocurre un error, configura el error en el objeto Response
       return Response(error=str(e))
-    
 
-def getDataPerRegion(workspace, stores, dates, user, passw, shp_workspace, shp_store):
-    try:
-
-      url_root = "https://geo.aclimate.org/geoserver/"
-      base_url = f"{url_root}{workspace}/ows?"
-      base_url_shp = f"{url_root}{shp_workspace}/ows?"
-
-      params = {
-        "service": "WFS",
-        "request": "GetFeature",
-        "version": "1.0.0",
-        "typeName": shp_workspace+":"+shp_store,
-        "outputFormat": "application/json",
-        "maxFeatures": 50,
-        "src": "EPSG:4326"
-      } 
-      url = base_url_shp + urlencode(params)
-      response = requests.get(url, auth=(user, passw))
 
+def calculate_means(workspace, coverage_ids, dates, user, passw, bbox=None, max_workers=None):
+    """Mean of every coverage on every [year, month] as {coverage: {"YYYY-MM": mean}}."""
+    try:
+      tasks = [(coverage_id, int(date[0]), int(date[1])) for coverage_id in coverage_ids for date in dates]
+      # Filled in request order first so the table keeps it whatever order downloads finish in
+      table = {coverage_id: {} for coverage_id in coverage_ids}
+      for coverage_id, year, month in tasks:
+          table[coverage_id][f"{year:04d}-{month:02d}"] = "Null"
+
+      with download_pool(max_workers) as executor:
+          futures = {executor.submit(in_context(get_coverage), workspace, coverage_id, year, month, user, passw, bbox): (coverage_id, year, month)
+                     for coverage_id, year, month in tasks}
+          for future in as_completed(futures):
+              coverage_id, year, month = futures.pop(future)
+              coverage = future.result()
+              with stage("mean"):
+                  mean_value = None if coverage is None else coverage_mean(coverage)
+              table[coverage_id][f"{year:04d}-{month:02d}"] = "Null" if mean_value is None else mean_value
+
+      return Response(res=table)
+    except Exception as e:
+      print(e)
+      return Response(error=str(e))
+    
 
-      shapefile = json.loads(response.content)
-      
+def getDataPerRegion(workspace, stores, dates, user, passw, shp_workspace, shp_store, statistics=None, simplify=False):
+    try:
+      # Without an explicit list only the mean is reported, as a plain value per store
+      single_value = statistics is None
+      statistics = statistics or ["mean"]
+      unknown = [stat for stat in statistics if stat not in STATISTICS]
+      if unknown:
+          return Response(error=f"Unknown statistics: {', '.join(unknown)}")
+
+      features = get_features(shp_workspace, shp_store, user, passw)
+      geometries = [feature['geometry'] for feature in features]
+
+      # Only the envelope of the regions is requested from the WCS
+      region_envelope = envelope(geometries)
+
+      # Each (store, date) coverage is downloaded once and shared by every geometry
+      pairs = []
+      for date in dates:
+          for store in stores:
+              if (store, tuple(date)) not in pairs:
+                  pairs.append((store, tuple(date)))
+
+      with download_pool() as executor:
+          futures = {pair: executor.submit(in_context(get_coverage), workspace, pair[0], pair[1][0], pair[1][1], user, passw, region_envelope) for pair in pairs}
+          coverages = {pair: future.result() for pair, future in futures.items()}
+
+      # All regions are summarised in a single pass over each coverage
+      zone_results = {}
+      for (store, date), coverage in coverages.items():
+          if coverage is None:
+              raise ValueError(f"No coverage found for store '{store}' on date '{list(date)}'")
+          labels = get_label_grid(layer_key(shp_workspace, shp_store), geometries, coverage.profile, simplify)
+          zone_results[(store, date)] = zonal_stats(coverage.array, labels, len(features), statistics)
 
       results = {}
 
-      for geometry in shapefile['features']:
-          department = geometry["properties"]["ADM1_EN"]
+      for index, feature in enumerate(features):
+          department = feature["properties"]["ADM1_EN"]
           department_data = {}
           for i, date in enumerate(dates, start=1):
               season_data = {}
-              
+
               # Iterate over each store
               for store in stores:
-                  # Get the raster corresponding to the store and date
-                  params = {
-                      "service": "WCS",
-                      "request": "GetCoverage",
-                      "version": "2.0.1",
-                      "coverageId": store,
-                      "format": "image/geotiff",
-                      "subset": f"Time(\"{date[0]:04d}-{date[1]:02d}-01T00:00:00.000Z\")"
-                  }
-                  url = base_url + urlencode(params)
-                  response = requests.get(url, auth=(user, passw))
-                  
-                  # Mask the raster with the current geometry
-                  with MemoryFile(response.content) as memfile:
-                      with memfile.open() as raster:
-                          try:
-                              out_image, _ = mask(raster, [geometry['geometry']], crop=True)
-                              masked_out_image = np.ma.masked_where(out_image < 0, out_image)
-                              average_without_min = masked_out_image.mean()
-
-                              if np.ma.is_masked(average_without_min):
-                                  average_without_min = "Null"
-                              else:
-                                  average_without_min = float(average_without_min)
-                              
-                              season_data[store] = average_without_min
-                          except Exception as e:
-                              print(f"Error masking raster for store '{store}' on date '{date}': {e}")
-              
+                  zone = zone_results[(store, tuple(date))][index]
+                  values = {stat: "Null" if value is None else value for stat, value in zone.items()}
+                  season_data[store] = values["mean"] if single_value else values
+
               department_data[f"season_{i}"] = season_data
-          
+
           results[department] = department_data
-      json_results = json.dumps(results, indent=4)
+
+      with stage("json_encode"):
+          json_results = json.dumps(results, indent=4)
 
       return Response(res=json_results)
     except Exception as e:
@@ -308,41 +310,183 @@ def getDataPerRegion(workspace, stores, dates, user, passw, shp_workspace, shp_s
         
 
       
-def importGeoserver(workspace, user, passw, geo_url, store, tiff):
+def expand_dates(start, end):
+    """Every [year, month] from start to end, both included."""
+    year, month = int(start[0]), int(start[1])
+    dates = []
+    while (year, month) <= (int(end[0]), int(end[1])):
+        dates.append([year, month])
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return dates
+
+
+def getTimeSeries(workspace, coverage_id, dates, user, passw, point=None, bbox=None, shp_workspace=None, shp_store=None, statistic="mean", max_workers=None):
     try:
-        root_path  = os.path.dirname(os.path.realpath(__file__))
+      if statistic not in STATISTICS:
+          return Response(error=f"Unknown statistic: {statistic}")
+
+      features = None
+      if point is not None:
+          # A small window around the point is enough to sample it
+          x, y = float(point[0]), float(point[1])
+          bbox = (x - POINT_BUFFER, y - POINT_BUFFER, x + POINT_BUFFER, y + POINT_BUFFER)
+      elif shp_workspace and shp_store:
+          features = get_features(shp_workspace, shp_store, user, passw)
+          bbox = envelope([feature['geometry'] for feature in features])
+
+      def reduce(coverage):
+          if coverage is None:
+              return None
+          array, profile = coverage.array, coverage.profile
+          # Negative values are valid data (temperature minima, anomalies), only the declared nodata is not
+          nodata = NODATA if profile.get('nodata') is None else profile['nodata']
+          if point is not None:
+              row, col = rowcol(profile['transform'], x, y)
+              if not (0 <= row < array.shape[0] and 0 <= col < array.shape[1]):
+                  return None
+              value = float(array[row, col])
+              if np.isnan(value) or value == nodata:
+                  return None
+              return value
+          if features is not None:
+              labels = get_label_grid(layer_key(shp_workspace, shp_store), [feature['geometry'] for feature in features], profile)
+              return [zone[statistic] for zone in zonal_stats(array, labels, len(features), [statistic], nodata)]
+          labels = np.ones(array.shape, dtype=np.int32)
+          return zonal_stats(array, labels, 1, [statistic], nodata)[0][statistic]
+
+      # Each coverage is reduced as soon as it arrives and then released
+      values = {}
+      with download_pool(max_workers) as executor:
+          futures = {executor.submit(in_context(get_coverage), workspace, coverage_id, date[0], date[1], user, passw, bbox): index for index, date in enumerate(dates)}
+          for future in as_completed(futures):
+              values[futures.pop(future)] = reduce(future.result())
+
+      def entry(index, value):
+          date = dates[index]
+          return {"date": f"{int(date[0]):04d}-{int(date[1]):02d}", "value": "Null" if value is None else value}
+
+      if features is None:
+          series = [entry(index, values[index]) for index in range(len(dates))]
+      else:
+          series = {}
+          for zone, feature in enumerate(features):
+              series[feature["properties"]["ADM1_EN"]] = [
+                  entry(index, None if values[index] is None else values[index][zone]) for index in range(len(dates))]
+
+      return Response(res={"coverage": coverage_id, "statistic": statistic, "series": series})
+    except Exception as e:
+      print(e)
+      return Response(error=str(e))
+
 
+def granule_date(filename):
+    """(year, month) of a filename_YYYYmm.tif granule, None for other names."""
+    match = re.match(r'^.+_(\d{4})(\d{2})\.tif$', filename)
+    if not match:
+        return None
+    return int(match.group(1)), int(match.group(2))
+
+
+def update_aggregates(workspace, granules, user, passw):
+    """
+    Refresh the cached coverage, the cached results and the aggregate store
+    for newly imported (store, filename_YYYYmm.tif) granules. Failures are
+    logged, the import itself already succeeded.
+    """
+    if granules:
+        result_cache.bump_version()
+    for store, filename in granules:
+        date = granule_date(filename)
+        if date is None:
+            continue
+        year, month = date
+        coverage_cache.invalidate(coverage_resource(workspace, store, year, month))
+        if aggregate_store is None:
+            continue
+        try:
+            coverage = get_coverage(workspace, store, year, month, user, passw)
+            if coverage is not None:
+                aggregate_store.add(workspace, store, year, month, coverage)
+        except Exception as e:
+            print(e)
+
+
+def importGeoserver(workspace, user, passw, geo_url, store, tiff):
+    try:
         patron = r'^.+_\d{6}\.tif$'
 
    
         regex = re.compile(patron)
 
-        if not regex.match(tiff.filename):
+        filename = os.path.basename(tiff.filename or "")
+        if not regex.match(filename):
             return Response(error="El nombre no coincide con el patron filename_YYYYmm.tif")
 
-        geoserver_path= os.path.join(root_path, "geoserverConexion")
-        layer_path= os.path.join(geoserver_path, "layers")
-        zip_path= os.path.join(geoserver_path, "zip")
-        tmp_path= os.path.join(geoserver_path, "tmp")
-        store_path= os.path.join(layer_path, store)
-        os.makedirs(store_path, exist_ok=True)
-        os.makedirs(tmp_path, exist_ok=True)
-        os.makedirs(zip_path, exist_ok=True)
-        tiff.save(os.path.join(store_path, tiff.filename))
+        # The upload is streamed straight into a zip private to this request
         geoserver = GeoserverImport(workspace, user, passw, geo_url)
-        result = geoserver.connect_geoserver()
-        shutil.rmtree(store_path)
-        shutil.rmtree(tmp_path)
-        shutil.rmtree(zip_path)
+        result = geoserver.import_granules(store, [(filename, tiff.stream)])
         if not result:
             return Response(error="Error al guardar")
 
+        update_aggregates(workspace, [(store, filename)], user, passw)
         return Response(res="Se guardo correctamente")
     except Exception as e:
       return Response(error=str(e))
     
 
 
+def importGeoserverBatch(workspace, user, passw, geo_url, files, store=None, stores=None):
+    try:
+        regex = re.compile(r'^(.+)_\d{6}\.tif$')
+        stores = stores or {}
+
+        # Expand uploaded archives into their members
+        granules = []
+        for file in files:
+            filename = os.path.basename(file.filename or "")
+            if filename.lower().endswith(".zip"):
+                archive = ZipFile(file.stream)
+                for member in archive.infolist():
+                    if not member.is_dir():
+                        granules.append((os.path.basename(member.filename), archive.open(member)))
+            else:
+                granules.append((filename, file.stream))
+
+        # Every name is validated before anything is sent to GeoServer
+        report = []
+        by_store = {}
+        for filename, source in granules:
+            match = regex.match(filename)
+            target = stores.get(filename) or store or (match.group(1) if match else None)
+            entry = {"file": filename, "store": target}
+            if not match:
+                entry["status"] = "invalid"
+                entry["error"] = "El nombre no coincide con el patron filename_YYYYmm.tif"
+            else:
+                entry["status"] = "pending"
+                by_store.setdefault(target, []).append((filename, source))
+            report.append(entry)
+
+        if any(entry["status"] == "invalid" for entry in report):
+            return Response(res=report, error="Some files do not match the pattern filename_YYYYmm.tif")
+
+        # One zip and one create/harvest per store, stores in parallel
+        geoserver = GeoserverImport(workspace, user, passw, geo_url)
+        with ThreadPoolExecutor(max_workers=max(1, min(len(by_store), 4))) as executor:
+            futures = {name: executor.submit(in_context(geoserver.import_granules), name, store_granules) for name, store_granules in by_store.items()}
+            store_results = {name: future.result() for name, future in futures.items()}
+
+        for entry in report:
+            entry["status"] = "imported" if store_results[entry["store"]] else "failed"
+        update_aggregates(workspace, [(entry["store"], entry["file"]) for entry in report if entry["status"] == "imported"], user, passw)
+
+        if not all(store_results.values()):
+            return Response(res=report, error="Error al guardar")
+        return Response(res=report)
+    except Exception as e:
+      return Response(error=str(e))
+
+
 def getGeoserverStores(workspace, user, passw, geo_url):
     try:
         geoserver = GeoserverImport(workspace, user, passw, geo_url)
@@ -0,0 +1,181 @@
+import hashlib
+import json
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+
+class JobQueue(object):
+    """
+    Runs long computations in a bounded process pool. Jobs are identified by
+    a hash of their parameters, so submitting a job identical to one that is
+    pending or has a stored successful result returns the existing job id; a
+    failed job is run again. Results
+    are stored in results_dir as a JSON record, plus the raw bytes of binary
+    results, and removed after ttl seconds, which also lets other gunicorn
+    workers serve them.
+    """
+
+    def __init__(self, workers, results_dir, ttl):
+        self.workers = workers
+        self.results_dir = results_dir
+        self.ttl = ttl
+        self._executor = None
+        self._jobs = {}
+        self._lock = threading.Lock()
+        os.makedirs(self.results_dir, mode=0o700, exist_ok=True)
+
+    def job_id(self, name, params):
+        encoded = json.dumps([name, params], sort_keys=True, default=str)
+        return hashlib.sha256(encoded.encode("utf-8")).hexdigest()[:32]
+
+    def submit(self, name, params, fn, *args):
+        """params identify the job, fn(*args) must return a Response."""
+        job_id = self.job_id(name, params)
+        with self._lock:
+            self._purge()
+            job = self._jobs.get(job_id)
+            if job is not None and job["status"] == "pending":
+                return job_id
+            record = self._load(job_id)
+            if record is not None:
+                if record["status"] != "failed":
+                    return job_id
+                self._remove_record(job_id)
+
+            try:
+                future = self._pool().submit(fn, *args)
+            except BrokenProcessPool:
+                # A worker died (e.g. killed for memory), the pool refuses every later job
+                self._reset_pool()
+                future = self._pool().submit(fn, *args)
+            self._jobs[job_id] = {"name": name, "status": "pending", "submitted_at": time.time(),
+                                  "executor": self._executor, "future": future}
+        future.add_done_callback(lambda f: self._finish(job_id, f))
+        return job_id
+
+    def _pool(self):
+        if self._executor is None:
+            # Forking a threaded server can copy a held lock into the child and deadlock it
+            self._executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                 mp_context=multiprocessing.get_context("spawn"))
+        return self._executor
+
+    def _reset_pool(self):
+        """Drop a broken pool and fail the jobs that were still pending in it. Called with the lock held."""
+        broken = self._executor
+        self._executor = None
+        if broken is not None:
+            broken.shutdown(wait=False)
+        for job_id, job in list(self._jobs.items()):
+            if job["executor"] is broken:
+                self._write_record(job_id, job["name"], None, "The job worker process died")
+                del self._jobs[job_id]
+
+    def status(self, job_id):
+        record = self._load(job_id)
+        if record is not None:
+            return {"job_id": job_id, "name": record["name"], "status": record["status"], "error": record["error"]}
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is None:
+            return None
+        return {"job_id": job_id, "name": job["name"], "status": job["status"], "error": None}
+
+    def result(self, job_id):
+        """Stored record with name, status, result and error, None if unknown or expired."""
+        return self._load(job_id)
+
+    def _finish(self, job_id, future):
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is None or job["future"] is not future:
+            # Already failed by _reset_pool
+            return
+        try:
+            response = future.result()
+            error = response.error
+            result = response.res
+        except BrokenProcessPool:
+            error = "The job worker process died"
+            result = None
+            with self._lock:
+                if self._executor is job["executor"]:
+                    self._executor = None
+        except Exception as e:
+            error = str(e)
+            result = None
+        self._write_record(job_id, job["name"], result, error)
+        with self._lock:
+            self._jobs.pop(job_id, None)
+
+    def _write_record(self, job_id, name, result, error):
+        record = {
+            "name": name,
+            "status": "failed" if error else "done",
+            "result": result,
+            "error": error,
+            "finished_at": time.time(),
+        }
+        if isinstance(result, bytes):
+            # The GeoTIFF is kept as is, the JSON record is written last and marks completion
+            self._write_atomic(self._path(job_id, ".bin"), result)
+            record["result"] = None
+            record["binary"] = True
+        self._write_atomic(self._path(job_id), json.dumps(record).encode("utf-8"))
+
+    def _path(self, job_id, suffix=".json"):
+        return os.path.join(self.results_dir, job_id + suffix)
+
+    def _write_atomic(self, path, content):
+        fd, tmp_path = tempfile.mkstemp(dir=self.results_dir, suffix=".part")
+        with os.fdopen(fd, "wb") as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+
+    def _load(self, job_id):
+        try:
+            with open(self._path(job_id)) as f:
+                record = json.load(f)
+            if time.time() - record["finished_at"] > self.ttl:
+                self._remove_record(job_id)
+                return None
+            if record.pop("binary", False):
+                with open(self._path(job_id, ".bin"), "rb") as f:
+                    record["result"] = f.read()
+        except (OSError, ValueError, KeyError):
+            return None
+        return record
+
+    def _remove_record(self, job_id):
+        self._remove(self._path(job_id))
+        self._remove(self._path(job_id, ".bin"))
+
+    def _purge(self):
+        now = time.time()
+        for name in os.listdir(self.results_dir):
+            if not name.endswith((".json", ".bin")):
+                continue
+            path = os.path.join(self.results_dir, name)
+            try:
+                if now - os.path.getmtime(path) > self.ttl:
+                    os.remove(path)
+            except OSError:
+                pass
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+job_queue = JobQueue(
+    workers=int(os.environ.get("JOB_WORKERS", "2")),
+    results_dir=os.environ.get("JOB_RESULTS_DIR", os.path.join(tempfile.gettempdir(), "aclimate_jobs")),
+    ttl=int(os.environ.get("JOB_RESULT_TTL", "3600")),
+)
@@ -1,14 +1,97 @@
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, request, jsonify, send_file, stream_with_context, g
 from flask_cors import CORS
 from io import BytesIO
 import json
+import time
 
-from import_requests import main, calculate_mean, getDataPerRegion, importGeoserver, getGeoserverStores
+from import_requests import main, calculate_mean, calculate_means, getDataPerRegion, getTimeSeries, expand_dates, importGeoserver, importGeoserverBatch, getGeoserverStores
+from coverage_cache import coverage_cache
+from wcs import upstream
+from jobs import job_queue
+from raster_sources import get_coverage
+from raster_output import output_options
+from result_cache import result_cache, subtract_rasters_params, global_average_params, global_average_batch_params, data_region_params
+from post_import import schedule_warmup
+from windowed import WINDOWED_DEFAULT
+import metrics
 
 app = Flask(__name__)
 CORS(app)
 
 
+@app.before_request
+def start_metrics():
+    g.metrics_token = metrics.start_request()
+
+
+@app.after_request
+def add_server_timing(response):
+    current = metrics.current()
+    if current is not None:
+        response.headers['Server-Timing'] = current.server_timing()
+        labels = {'endpoint': request.endpoint or 'unknown', 'status': str(response.status_code)}
+        metrics.registry.observe('aclimate_request_seconds', labels, time.perf_counter() - current.started,
+                                 'Request duration until the response is built.')
+    return response
+
+
+@app.teardown_request
+def end_metrics(exc):
+    token = g.pop('metrics_token', None)
+    if token is not None:
+        metrics.end_request(token)
+
+
+def can_read(workspace, coverage_id, year, month, user, passw):
+    """Whether GeoServer serves one coverage of a product to these credentials."""
+    try:
+        return get_coverage(workspace, coverage_id, int(year), int(month), user, passw) is not None
+    except Exception as e:
+        print(e)
+        return False
+
+
+def cached_response(name, params, compute, build, probe):
+    """
+    Serve a computed product through the result cache. build(value) makes the
+    response body; an If-None-Match matching the stored ETag gets a 304.
+
+    Shared entries are stored without credentials, so before one is served
+    probe (the can_read arguments of one input) must pass with the caller's;
+    otherwise the product is computed with them and not cached.
+    """
+    key = result_cache.key(name, params)
+    entry = result_cache.get(key)
+    if entry is not None and result_cache.shared and not can_read(*probe):
+        result = compute()
+        if result.error:
+            return jsonify({'error': result.error}), 400
+        response = build(result.res)
+        response.headers['Cache-Control'] = 'private, no-store'
+        return response
+    if entry is None:
+        result = compute()
+        if result.error:
+            return jsonify({'error': result.error}), 400
+        entry = result_cache.put(key, result.res)
+    if request.if_none_match.contains(entry['etag']):
+        response = app.response_class(status=304)
+    else:
+        response = build(entry['value'])
+    response.set_etag(entry['etag'])
+    scope = 'public' if result_cache.shared else 'private'
+    response.headers['Cache-Control'] = f'{scope}, max-age={result_cache.ttl}'
+    return response
+
+
+def json_body(value):
+    return jsonify({'body': value})
+
+
+def tiff_body(value):
+    return send_file(BytesIO(value), mimetype='image/tiff')
+
+
 @app.route('/api/subtract_rasters', methods=['POST'])
 def calculate_subtraction():
     data = request.json
@@ -17,14 +100,38 @@ def calculate_subtraction():
     user = data.get('user')
     passw = data.get('passw')
     anomalie = data.get('anomalie', True)
+    max_workers = data.get('max_workers')
+    output_format = data.get('format', 'geotiff')
+    dissolve = data.get('dissolve', False)
+    bbox = data.get('bbox')
+    output = data.get('output')
+    windowed = data.get('windowed', WINDOWED_DEFAULT)
     if not years or not month or not user or not passw:
         return jsonify({'error': 'The array of years and the month are required.'}), 400
-    result = main(years, month, user, passw, anomalie)
+    try:
+        output = output_options(output)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    if output_format not in ('geotiff', 'geojson'):
+        return jsonify({'error': 'The format must be geotiff or geojson.'}), 400
+    if bbox is not None and len(bbox) != 4:
+        return jsonify({'error': 'The bbox must be [minx, miny, maxx, maxy].'}), 400
+    if data.get('async'):
+        if output_format != 'geotiff':
+            return jsonify({'error': 'Asynchronous jobs only produce geotiff.'}), 400
+        job_id = job_queue.submit('subtract_rasters', data, main, years, month, user, passw, anomalie, max_workers, 'geotiff', False, bbox, output, windowed)
+        return jsonify({'body': {'job_id': job_id, 'status_url': f'/api/jobs/{job_id}'}}), 202
+    if output_format == 'geotiff':
+        params = subtract_rasters_params(years, month, anomalie, bbox, output, user, passw)
+        return cached_response('subtract_rasters', params,
+                               lambda: main(years, month, user, passw, anomalie, max_workers, output_format, dissolve, bbox, output, windowed),
+                               tiff_body, ('historical_climate_hn', 'PREC', years[0], month, user, passw))
+    result = main(years, month, user, passw, anomalie, max_workers, output_format, dissolve, bbox, output)
 
     if result.error:
         return jsonify({'error': result.error}), 400
     else:
-        return send_file(BytesIO(result.res), mimetype='image/tiff')
+        return app.response_class(stream_with_context(result.res), mimetype='application/geo+json')
 
 
 @app.route('/api/global_average', methods=['POST'])
@@ -36,14 +143,29 @@ def calculate_average():
     month = data.get('month')
     user = data.get('user')
     passw = data.get('passw')
-    if not years or not month or not user or not passw or not workspace or not mosaic_name:
+    bbox = data.get('bbox')
+    coverages = data.get('coverages')
+    dates = data.get('dates')
+    windowed = data.get('windowed', WINDOWED_DEFAULT)
+    batch = bool(coverages or dates)
+    if batch:
+        coverages = coverages or ([mosaic_name] if mosaic_name else None)
+        dates = dates or ([[years, month]] if years and month else None)
+        if not coverages or not dates or not user or not passw or not workspace:
+            return jsonify({'error': 'The coverages and the dates are required.'}), 400
+    elif not years or not month or not user or not passw or not workspace or not mosaic_name:
         return jsonify({'error': 'The array of years and the month are required.'}), 400
-    result = calculate_mean(workspace, mosaic_name, years, month, user, passw)
-
-    if result.error:
-        return jsonify({'error': result.error}), 400
-    else:
-        return jsonify({'body': result.res}), 200
+    if bbox is not None and len(bbox) != 4:
+        return jsonify({'error': 'The bbox must be [minx, miny, maxx, maxy].'}), 400
+    if batch:
+        params = global_average_batch_params(workspace, coverages, dates, bbox, user, passw)
+        return cached_response('global_average_batch', params,
+                               lambda: calculate_means(workspace, coverages, dates, user, passw, bbox),
+                               json_body, (workspace, coverages[0], dates[0][0], dates[0][1], user, passw))
+    params = global_average_params(workspace, mosaic_name, years, month, bbox, user, passw)
+    return cached_response('global_average', params,
+                           lambda: calculate_mean(workspace, mosaic_name, years, month, user, passw, bbox, windowed),
+                           json_body, (workspace, mosaic_name, years, month, user, passw))
     
 
 @app.route('/api/data_region', methods=['POST'])
@@ -56,15 +178,53 @@ def calculate_data_region():
     dates = data.get('dates')
     user = data.get('user')
     passw = data.get('passw')
+    statistics = data.get('statistics')
+    simplify = data.get('simplify', False)
     if not dates or not user or not passw or not workspace or not stores or not shp_workspace or not shp_store:
         return jsonify({'error': 'The array of years and the month are required.'}), 400
-    result = getDataPerRegion(workspace, stores, dates, user, passw, shp_workspace, shp_store)
+    if data.get('async'):
+        job_id = job_queue.submit('data_region', data, getDataPerRegion, workspace, stores, dates, user, passw, shp_workspace, shp_store, statistics, simplify)
+        return jsonify({'body': {'job_id': job_id, 'status_url': f'/api/jobs/{job_id}'}}), 202
+    params = data_region_params(workspace, stores, dates, shp_workspace, shp_store, statistics, simplify, user, passw)
+    return cached_response('data_region', params,
+                           lambda: getDataPerRegion(workspace, stores, dates, user, passw, shp_workspace, shp_store, statistics, simplify),
+                           json_body, (workspace, stores[0], dates[0][0], dates[0][1], user, passw))
+    
+
+@app.route('/api/time_series', methods=['POST'])
+def calculate_time_series():
+    data = request.json
+    workspace = data.get('workspace')
+    coverage = data.get('coverage')
+    dates = data.get('dates')
+    start = data.get('start')
+    end = data.get('end')
+    point = data.get('point')
+    bbox = data.get('bbox')
+    region = data.get('region') or {}
+    statistic = data.get('statistic', 'mean')
+    user = data.get('user')
+    passw = data.get('passw')
+    if not dates and start and end:
+        dates = expand_dates(start, end)
+    if not dates or not user or not passw or not workspace or not coverage:
+        return jsonify({'error': 'The workspace, coverage and dates (or start and end) are required.'}), 400
+    if bool(point) + bool(bbox) + bool(region) != 1:
+        return jsonify({'error': 'Exactly one of point, bbox or region is required.'}), 400
+    if point is not None and len(point) != 2:
+        return jsonify({'error': 'The point must be [x, y].'}), 400
+    if bbox is not None and len(bbox) != 4:
+        return jsonify({'error': 'The bbox must be [minx, miny, maxx, maxy].'}), 400
+    if region and (not region.get('shp_workspace') or not region.get('shp_store')):
+        return jsonify({'error': 'The region must include shp_workspace and shp_store.'}), 400
+    result = getTimeSeries(workspace, coverage, dates, user, passw, point, bbox,
+                           region.get('shp_workspace'), region.get('shp_store'), statistic)
 
     if result.error:
         return jsonify({'error': result.error}), 400
     else:
         return jsonify({'body': result.res}), 200
-    
+
 
 @app.route('/api/import_geoserver', methods=['POST'])
 def import_geoserver():
@@ -84,9 +244,32 @@ def import_geoserver():
     if result.error:
         return jsonify({'error': result.error}), 400
     else:
+        schedule_warmup(workspace, [(store, file.filename)], user, passw)
         return jsonify({'body': result.res}), 200
 
 
+@app.route('/api/import_geoserver_batch', methods=['POST'])
+def import_geoserver_batch():
+    data = request.form['data']
+    files = request.files.getlist('files') + request.files.getlist('file')
+    json_data = json.loads(data)
+    workspace = json_data.get('workspace')
+    user = json_data.get('user')
+    passw = json_data.get('passw')
+    geo_url = json_data.get("geo_url")
+    store = json_data.get("store")
+    stores = json_data.get("stores")
+
+    if not user or not passw or not workspace or not files:
+        return jsonify({'error': 'The workspace, credentials and files are required.'}), 400
+    result = importGeoserverBatch(workspace, user, passw, geo_url, files, store, stores)
+
+    if result.error:
+        return jsonify({'error': result.error, 'body': result.res}), 400
+    else:
+        schedule_warmup(workspace, [(entry['store'], entry['file']) for entry in result.res], user, passw)
+        return jsonify({'body': result.res}), 200
+
 
 @app.route('/api/get_geo_stores', methods=['POST'])
 def get_stores():
@@ -105,5 +288,64 @@ def get_stores():
         return jsonify({'body': result.res}), 200
 
 
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    status = job_queue.status(job_id)
+    if status is None:
+        return jsonify({'error': 'Job not found or expired.'}), 404
+    return jsonify({'body': status}), 200
+
+
+@app.route('/api/jobs/<job_id>/result', methods=['GET'])
+def job_result(job_id):
+    record = job_queue.result(job_id)
+    if record is None:
+        status = job_queue.status(job_id)
+        if status is None:
+            return jsonify({'error': 'Job not found or expired.'}), 404
+        return jsonify({'body': status}), 202
+
+    if record['error']:
+        return jsonify({'error': record['error']}), 400
+    elif record['name'] == 'subtract_rasters':
+        return send_file(BytesIO(record['result']), mimetype='image/tiff')
+    else:
+        return jsonify({'body': record['result']}), 200
+
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    stats = coverage_cache.stats()
+    results = result_cache.stats()
+    limiters = upstream.state()
+    gauges = {
+        'aclimate_upstream_concurrency_limit': ('Adaptive concurrency limit per GeoServer host.',
+                                                [({'host': host}, state['limit']) for host, state in limiters.items()]),
+        'aclimate_upstream_in_flight': ('Requests in flight per GeoServer host.',
+                                        [({'host': host}, state['in_flight']) for host, state in limiters.items()]),
+        'aclimate_coverage_cache_bytes': ('Bytes held by the coverage cache.',
+                                          [({'tier': 'memory'}, stats['memory_bytes']), ({'tier': 'disk'}, stats['disk_bytes'])]),
+        'aclimate_coverage_cache_entries': ('Decoded coverages held in memory.', [({}, stats['memory_entries'])]),
+        'aclimate_result_cache_bytes': ('Bytes held by the result cache.',
+                                        [({'tier': 'memory'}, results['memory_bytes']), ({'tier': 'disk'}, results['disk_bytes'])]),
+    }
+    return app.response_class(metrics.registry.render(gauges), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/api/result_cache', methods=['GET'])
+def result_cache_stats():
+    return jsonify({'body': result_cache.stats()}), 200
+
+
+@app.route('/api/upstream', methods=['GET'])
+def upstream_state():
+    return jsonify({'body': upstream.state()}), 200
+
+
+@app.route('/api/coverage_cache', methods=['GET'])
+def coverage_cache_stats():
+    return jsonify({'body': coverage_cache.stats()}), 200
+
+
 if __name__ == '__main__':
     app.run(debug=True)
@@ -0,0 +1,150 @@
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_current = contextvars.ContextVar("request_metrics", default=None)
+
+
+class RequestMetrics(object):
+    """Stage timings and counters of one HTTP request."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages = {}
+        self._lock = threading.Lock()
+
+    def add_stage(self, name, start, end):
+        """
+        Stages run in parallel by pool threads are reported as the wall-clock
+        span from their first start to their last end, not the summed time.
+        """
+        with self._lock:
+            first, last = self.stages.get(name, (start, end))
+            self.stages[name] = (min(first, start), max(last, end))
+
+    def server_timing(self):
+        with self._lock:
+            stages = list(self.stages.items())
+        total = time.perf_counter() - self.started
+        parts = [f"{name};dur={(end - start) * 1000:.1f}" for name, (start, end) in stages]
+        parts.append(f"total;dur={total * 1000:.1f}")
+        return ", ".join(parts)
+
+
+class Registry(object):
+    """Process-wide histograms and counters rendered in Prometheus text format."""
+
+    def __init__(self):
+        self._histograms = {}
+        self._counters = {}
+        self._help = {}
+        self._lock = threading.Lock()
+
+    def observe(self, name, labels, value, help_text=""):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._help.setdefault(name, ("histogram", help_text))
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [[0] * len(BUCKETS), 0.0, 0]
+            for i, bound in enumerate(BUCKETS):
+                if value <= bound:
+                    histogram[0][i] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def inc(self, name, labels, value=1, help_text=""):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._help.setdefault(name, ("counter", help_text))
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def render(self, gauges=None):
+        lines = []
+        with self._lock:
+            histograms = sorted(self._histograms.items())
+            counters = sorted(self._counters.items())
+            help_entries = dict(self._help)
+        described = set()
+
+        def describe(name, kind, help_text):
+            if name not in described:
+                described.add(name)
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+
+        for (name, labels), (buckets, total, count) in histograms:
+            describe(name, *help_entries[name])
+            for bound, value in zip(BUCKETS, buckets):
+                lines.append(f"{name}_bucket{_labels(labels + (('le', str(bound)),))} {value}")
+            lines.append(f"{name}_bucket{_labels(labels + (('le', '+Inf'),))} {count}")
+            lines.append(f"{name}_sum{_labels(labels)} {total}")
+            lines.append(f"{name}_count{_labels(labels)} {count}")
+        for (name, labels), value in counters:
+            describe(name, *help_entries[name])
+            lines.append(f"{name}{_labels(labels)} {value}")
+        for name, (help_text, values) in sorted((gauges or {}).items()):
+            describe(name, "gauge", help_text)
+            for labels, value in values:
+                lines.append(f"{name}{_labels(tuple(sorted(labels.items())))} {value}")
+        return "\n".join(lines) + "\n"
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+
+registry = Registry()
+
+
+def start_request():
+    return _current.set(RequestMetrics())
+
+
+def end_request(token):
+    _current.reset(token)
+
+
+def current():
+    return _current.get()
+
+
+@contextmanager
+def stage(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        end = time.perf_counter()
+        elapsed = end - start
+        metrics = _current.get()
+        if metrics is not None:
+            metrics.add_stage(name, start, end)
+        registry.observe("aclimate_stage_seconds", {"stage": name}, elapsed,
+                         "Time spent in each processing stage.")
+
+
+def record_upstream(kind, status, nbytes):
+    registry.inc("aclimate_upstream_requests_total", {"kind": kind, "status": str(status)}, 1,
+                 "Requests sent to GeoServer.")
+    registry.inc("aclimate_upstream_bytes_total", {"kind": kind}, nbytes,
+                 "Bytes received from GeoServer.")
+
+
+def count(name, labels=None, value=1, help_text=""):
+    registry.inc(name, labels or {}, value, help_text)
+
+
+def in_context(fn):
+    """Bind fn to a copy of the caller's context so pool threads report to the same request."""
+    context = contextvars.copy_context()
+
+    def run(*args, **kwargs):
+        return context.run(fn, *args, **kwargs)
+    return run
@@ -0,0 +1,95 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from import_requests import calculate_mean, getDataPerRegion, granule_date, main
+from metrics import count, stage
+from raster_output import output_options
+from result_cache import data_region_params, global_average_params, result_cache, subtract_rasters_params
+
+
+# Products computed after a successful import, empty to disable the warm-up
+POST_IMPORT_PRODUCTS = [name for name in os.environ.get("POST_IMPORT_PRODUCTS", "anomaly,mean,regions").split(",") if name]
+
+# workspace:store of the granules /api/subtract_rasters averages
+POST_IMPORT_ANOMALY_STORE = tuple(os.environ.get("POST_IMPORT_ANOMALY_STORE", "historical_climate_hn:PREC").split(":"))
+
+# shp_workspace:shp_store of the departments layer, empty to skip the regional stats
+POST_IMPORT_REGIONS = os.environ.get("POST_IMPORT_REGIONS", "")
+
+POST_IMPORT_WORKERS = int(os.environ.get("POST_IMPORT_WORKERS", "1"))
+
+_executor = None
+
+
+def warmup_enabled():
+    """
+    Warmed entries only help bulletin traffic when every gunicorn worker reads
+    them (a disk tier) and every user does (keys without credentials).
+    """
+    return bool(POST_IMPORT_PRODUCTS) and bool(result_cache.cache_dir) and result_cache.shared
+
+
+if POST_IMPORT_PRODUCTS and not warmup_enabled():
+    print("Post-import warm-up disabled: it needs RESULT_CACHE_DISK_MB > 0 and RESULT_CACHE_SHARED=1")
+
+
+def warmup_tasks(workspace, store, year, month, user, passw):
+    """(product, cache key, compute) of the standard products of a new month."""
+    tasks = []
+    if "anomaly" in POST_IMPORT_PRODUCTS and (workspace, store) == POST_IMPORT_ANOMALY_STORE:
+        output = output_options()
+        params = subtract_rasters_params([year], month, True, None, output, user, passw)
+        tasks.append(("anomaly", result_cache.key("subtract_rasters", params),
+                      lambda: main([year], month, user, passw, True, output=output)))
+    if "mean" in POST_IMPORT_PRODUCTS:
+        params = global_average_params(workspace, store, year, month, None, user, passw)
+        tasks.append(("mean", result_cache.key("global_average", params),
+                      lambda: calculate_mean(workspace, store, year, month, user, passw)))
+    if "regions" in POST_IMPORT_PRODUCTS and POST_IMPORT_REGIONS:
+        shp_workspace, shp_store = POST_IMPORT_REGIONS.split(":")
+        params = data_region_params(workspace, [store], [[year, month]], shp_workspace, shp_store, None, False, user, passw)
+        tasks.append(("regions", result_cache.key("data_region", params),
+                      lambda: getDataPerRegion(workspace, [store], [[year, month]], user, passw, shp_workspace, shp_store)))
+    return tasks
+
+
+def warmup(workspace, store, year, month, user, passw):
+    """
+    Compute the standard products of a newly imported month and store them in
+    the result cache, replacing entries computed before the import.
+    """
+    for product, key, compute in warmup_tasks(workspace, store, year, month, user, passw):
+        try:
+            with stage("warmup"):
+                result = compute()
+            if result.error:
+                print(f"Warm-up of {product} for {store} {year:04d}-{month:02d} failed: {result.error}")
+                status = "failed"
+            else:
+                result_cache.put(key, result.res)
+                status = "done"
+        except Exception as e:
+            print(e)
+            status = "failed"
+        count("aclimate_post_import_total", {"product": product, "status": status}, 1,
+              "Products precomputed after an import.")
+
+
+def schedule_warmup(workspace, granules, user, passw):
+    """
+    Queue the warm-up of every imported (store, filename_YYYYmm.tif) granule
+    in a background thread. Nothing is queued unless warmup_enabled().
+    """
+    global _executor
+    if not warmup_enabled():
+        return []
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=POST_IMPORT_WORKERS)
+
+    futures = []
+    for store, filename in granules:
+        date = granule_date(os.path.basename(filename or ""))
+        if date is None:
+            continue
+        futures.append(_executor.submit(warmup, workspace, store, date[0], date[1], user, passw))
+    return futures
@@ -0,0 +1,125 @@
+import numpy as np
+from rasterio.enums import Resampling
+from rasterio.io import MemoryFile
+from rasterio.shutil import copy as copy_raster
+
+from accumulator import NODATA
+from metrics import stage
+
+
+OUTPUT_DEFAULTS = {
+    "dtype": "float32",
+    "compress": "deflate",
+    "tiled": True,
+    "blocksize": 256,
+    "overviews": False,
+    "cog": False,
+}
+
+DTYPES = ("float32", "float64", "int16", "int32")
+COMPRESSIONS = ("none", "deflate", "zstd", "lzw")
+
+
+def output_options(options=None):
+    """Validate the output options of a request, filling in the defaults."""
+    result = dict(OUTPUT_DEFAULTS)
+    for key, value in (options or {}).items():
+        if key not in OUTPUT_DEFAULTS:
+            raise ValueError(f"Unknown output option: {key}")
+        result[key] = value
+    result["compress"] = str(result["compress"]).lower()
+    if result["dtype"] not in DTYPES:
+        raise ValueError(f"The output dtype must be one of {', '.join(DTYPES)}")
+    if result["compress"] not in COMPRESSIONS:
+        raise ValueError(f"The output compression must be one of {', '.join(COMPRESSIONS)}")
+    if int(result["blocksize"]) <= 0 or int(result["blocksize"]) % 16:
+        raise ValueError("The output blocksize must be a multiple of 16")
+    result["blocksize"] = int(result["blocksize"])
+    return result
+
+
+def overview_factors(width, height, blocksize):
+    factors = []
+    factor = 2
+    while min(width, height) / factor >= blocksize / 2:
+        factors.append(factor)
+        factor *= 2
+    return factors
+
+
+def geotiff_profile(width, height, dtype, crs, transform, nodata, options):
+    """Profile with the creation options (compression, predictor, tiling) of a request."""
+    floating = np.issubdtype(np.dtype(dtype), np.floating)
+    profile = {
+        "driver": "GTiff",
+        "width": width,
+        "height": height,
+        "count": 1,
+        "dtype": dtype,
+        "crs": crs,
+        "transform": transform,
+        "nodata": nodata,
+    }
+    if options["compress"] != "none":
+        profile["compress"] = options["compress"]
+        profile["predictor"] = 3 if floating else 2
+    if options["tiled"] or options["cog"]:
+        profile.update(tiled=True, blockxsize=options["blocksize"], blockysize=options["blocksize"])
+    return profile
+
+
+def add_overviews(dataset, options):
+    if options["overviews"] and not options["cog"]:
+        factors = overview_factors(dataset.width, dataset.height, options["blocksize"])
+        if factors:
+            dataset.build_overviews(factors, Resampling.average)
+            dataset.update_tags(ns="rio_overview", resampling="average")
+
+
+def copy_to_cog(src_path, dst_path, profile, options):
+    # The COG driver only supports CreateCopy, it lays out the tiles and overviews itself
+    cog_options = {"blocksize": options["blocksize"], "overview_resampling": "average"}
+    if options["compress"] != "none":
+        cog_options.update(compress=options["compress"], predictor=profile["predictor"])
+    copy_raster(src_path, dst_path, driver="COG", **cog_options)
+
+
+def cast_output(array, dtype, nodata=NODATA):
+    """
+    array as the output dtype. Integer outputs are rounded to the nearest
+    value, and values they cannot hold (non-finite or out of range) become
+    nodata instead of wrapping around.
+    """
+    dtype = np.dtype(dtype)
+    if np.issubdtype(dtype, np.floating):
+        return array.astype(dtype, copy=False)
+    info = np.iinfo(dtype)
+    rounded = np.rint(np.asarray(array, dtype=np.float64))
+    with np.errstate(invalid="ignore"):
+        unrepresentable = ~np.isfinite(rounded) | (rounded < info.min) | (rounded > info.max)
+    rounded[unrepresentable] = nodata
+    return rounded.astype(dtype)
+
+
+def write_geotiff(array, crs, transform, nodata=NODATA, options=None):
+    """
+    Encode a single band raster as GeoTIFF bytes. By default the output is
+    float32, DEFLATE compressed with the matching predictor and tiled;
+    overviews and a Cloud Optimized GeoTIFF layout are optional.
+    """
+    options = output_options(options)
+    data = cast_output(array, options["dtype"], nodata)
+    profile = geotiff_profile(data.shape[1], data.shape[0], data.dtype, crs, transform, nodata, options)
+
+    with stage("encode"), MemoryFile() as memfile:
+        with memfile.open(**profile) as dataset:
+            dataset.write(data, 1)
+            add_overviews(dataset, options)
+        if not options["cog"]:
+            memfile.seek(0)
+            return memfile.read()
+
+        with MemoryFile() as cog:
+            copy_to_cog(memfile.name, cog.name, profile, options)
+            cog.seek(0)
+            return cog.read()
@@ -0,0 +1,118 @@
+import glob
+import os
+
+import rasterio
+from rasterio.windows import Window, from_bounds
+
+from coverage_cache import Coverage
+from metrics import count, stage
+from wcs import normalize_bbox
+import wcs
+
+
+# Where coverages are read from: "wcs" (GeoServer) or "local" (granule files under RASTER_ROOT)
+RASTER_BACKEND = os.environ.get("RASTER_BACKEND", "wcs")
+
+# Root of the mosaic granules, laid out as <root>/<workspace>/<store>/<store>_YYYYMM.tif
+RASTER_ROOT = os.environ.get("RASTER_ROOT", "")
+
+
+class WcsSource(object):
+    """Coverages requested from GeoServer with WCS GetCoverage."""
+
+    name = "wcs"
+
+    def get_coverage(self, workspace, coverage_id, year, month, user, passw, bbox=None):
+        return wcs.get_coverage(workspace, coverage_id, year, month, user, passw, bbox)
+
+    def spool_coverage(self, workspace, coverage_id, year, month, user, passw, directory, bbox=None):
+        return wcs.spool_coverage(workspace, coverage_id, year, month, user, passw, directory, bbox)
+
+
+class LocalSource(object):
+    """
+    Coverages read straight from the granule files GeoServer indexes, found
+    with the same yyyyMM file name suffix timeregex.properties extracts.
+    Only the window covering the bbox is read. GeoServer is not involved, so
+    its access rules are not applied and the credentials are ignored.
+    """
+
+    name = "local"
+
+    def __init__(self, root):
+        if not root:
+            raise ValueError("RASTER_ROOT is required by the local raster backend")
+        self.root = root
+
+    def granule_path(self, workspace, coverage_id, year, month):
+        """Path of the granule of a store for one month, None if there is none."""
+        pattern = os.path.join(self.root, workspace, coverage_id, f"*_{int(year):04d}{int(month):02d}.tif")
+        paths = sorted(glob.glob(pattern))
+        return paths[0] if paths else None
+
+    def window(self, dataset, bbox):
+        """Pixel window of the dataset intersecting bbox, like a WCS subset."""
+        full = Window(0, 0, dataset.width, dataset.height)
+        if bbox is None:
+            return full
+        window = from_bounds(*bbox, transform=dataset.transform)
+        window = window.round_offsets(op="floor").round_lengths(op="ceil")
+        return window.intersection(full)
+
+    def read(self, path, bbox):
+        with rasterio.open(path) as dataset:
+            window = self.window(dataset, bbox)
+            array = dataset.read(1, window=window)
+            profile = dataset.profile
+            profile.update(width=int(window.width), height=int(window.height),
+                           transform=dataset.window_transform(window))
+        return array, profile
+
+    def get_coverage(self, workspace, coverage_id, year, month, user, passw, bbox=None):
+        bbox = normalize_bbox(bbox)
+        path = self.granule_path(workspace, coverage_id, year, month)
+        count("aclimate_local_reads_total", {"found": str(path is not None).lower()}, 1,
+              "Granule lookups of the local raster backend.")
+        if path is None:
+            return None
+        with stage("read"):
+            array, profile = self.read(path, bbox)
+        array.setflags(write=False)
+        return Coverage(array, profile)
+
+    def spool_coverage(self, workspace, coverage_id, year, month, user, passw, directory, bbox=None):
+        bbox = normalize_bbox(bbox)
+        path = self.granule_path(workspace, coverage_id, year, month)
+        if path is None or bbox is None:
+            # The granule itself can be read block by block
+            return path
+
+        output_path = os.path.join(directory, f"{workspace}_{coverage_id}_{int(year):04d}{int(month):02d}.tif")
+        with stage("read"):
+            array, profile = self.read(path, bbox)
+            profile.update(driver="GTiff")
+            with rasterio.open(output_path, "w", **profile) as dst:
+                dst.write(array, 1)
+        return output_path
+
+
+def make_source(backend=None, root=None):
+    backend = backend or RASTER_BACKEND
+    if backend == "wcs":
+        return WcsSource()
+    if backend == "local":
+        return LocalSource(root or RASTER_ROOT)
+    raise ValueError(f"Unknown raster backend: {backend}")
+
+
+source = make_source()
+
+
+def get_coverage(workspace, coverage_id, year, month, user, passw, bbox=None):
+    """Decoded Coverage for one time step from the configured backend, None if missing."""
+    return source.get_coverage(workspace, coverage_id, year, month, user, passw, bbox)
+
+
+def spool_coverage(workspace, coverage_id, year, month, user, passw, directory, bbox=None):
+    """Path of a GeoTIFF file for one time step from the configured backend, None if missing."""
+    return source.spool_coverage(workspace, coverage_id, year, month, user, passw, directory, bbox)
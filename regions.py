@@ -0,0 +1,152 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from urllib.parse import urlencode
+
+from rasterio.features import bounds as geometry_bounds
+from shapely.geometry import mapping, shape
+
+from metrics import count
+from singleflight import host_lock, region_flight
+from wcs import URL_ROOT, credential_scope, fetch
+
+
+# Features requested per WFS GetFeature page
+WFS_PAGE_SIZE = int(os.environ.get("WFS_PAGE_SIZE", "500"))
+
+# Administrative boundaries rarely change, parsed layers are kept a week by default
+REGION_CACHE_TTL = int(os.environ.get("REGION_CACHE_TTL", str(7 * 24 * 3600)))
+REGION_CACHE_DIR = os.environ.get("REGION_CACHE_DIR", os.path.join(tempfile.gettempdir(), "aclimate_regions"))
+
+_layers = {}
+_fingerprints = {}
+_layers_lock = threading.Lock()
+
+
+def _cache_path(scope, shp_workspace, shp_store):
+    name = hashlib.sha256(f"{scope}:{shp_workspace}:{shp_store}".encode("utf-8")).hexdigest()
+    return os.path.join(REGION_CACHE_DIR, name + ".json")
+
+
+def fetch_features(shp_workspace, shp_store, user, passw):
+    """Every feature of a WFS layer, requested page by page."""
+    base_url_shp = f"{URL_ROOT}{shp_workspace}/ows?"
+    features = []
+    seen = set()
+    while True:
+        params = {
+          "service": "WFS",
+          "request": "GetFeature",
+          "version": "1.0.0",
+          "typeName": shp_workspace+":"+shp_store,
+          "outputFormat": "application/json",
+          "maxFeatures": WFS_PAGE_SIZE,
+          "startIndex": len(features),
+          "src": "EPSG:4326"
+        }
+        url = base_url_shp + urlencode(params)
+        response = fetch(url, user, passw, kind="wfs")
+        page = json.loads(response.content)['features']
+
+        # A server ignoring startIndex would return the first page forever
+        ids = [feature.get("id") for feature in page]
+        if page and ids[0] is not None and ids[0] in seen:
+            break
+        seen.update(ids)
+        features.extend(page)
+        if len(page) < WFS_PAGE_SIZE:
+            break
+    return features
+
+
+def get_features(shp_workspace, shp_store, user, passw):
+    """
+    GeoJSON features of a WFS layer. Parsed layers are cached in memory and
+    in REGION_CACHE_DIR for REGION_CACHE_TTL seconds, so warm calls do not
+    reach the WFS at all. Cached layers are only served to the credentials
+    that fetched them.
+    """
+    key = (credential_scope(user, passw), shp_workspace, shp_store)
+    with _layers_lock:
+        cached = _layers.get(key)
+    if cached is not None and time.time() - cached[0] < REGION_CACHE_TTL:
+        count("aclimate_region_cache_total", {"result": "memory_hit"}, 1, "Region layer cache lookups by result.")
+        return cached[1]
+
+    # Concurrent loads of a layer share one WFS download, also across workers
+    def load():
+        with host_lock(("wfs",) + key):
+            return _load_features(key, user, passw)
+    return region_flight.do(key, load)
+
+
+def _load_features(key, user, passw):
+    _, shp_workspace, shp_store = key
+    path = _cache_path(*key)
+    try:
+        fetched_at = os.path.getmtime(path)
+        if time.time() - fetched_at < REGION_CACHE_TTL:
+            with open(path) as f:
+                text = f.read()
+            features = json.loads(text)
+            _remember(key, fetched_at, features, text)
+            count("aclimate_region_cache_total", {"result": "disk_hit"}, 1, "Region layer cache lookups by result.")
+            return features
+    except (OSError, ValueError):
+        pass
+
+    count("aclimate_region_cache_total", {"result": "miss"}, 1, "Region layer cache lookups by result.")
+    features = fetch_features(shp_workspace, shp_store, user, passw)
+    text = json.dumps(features)
+    _remember(key, time.time(), features, text)
+    os.makedirs(REGION_CACHE_DIR, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=REGION_CACHE_DIR, suffix=".part")
+    with os.fdopen(fd, "w") as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+    return features
+
+
+def _remember(key, fetched_at, features, text):
+    fingerprint = hashlib.sha256(text.encode("utf-8")).hexdigest()[:16]
+    with _layers_lock:
+        _layers[key] = (fetched_at, features)
+        _fingerprints[key[1:]] = fingerprint
+
+
+def clear_cache():
+    """Forget every parsed layer, in memory and in REGION_CACHE_DIR."""
+    with _layers_lock:
+        _layers.clear()
+        _fingerprints.clear()
+    if os.path.isdir(REGION_CACHE_DIR):
+        for name in os.listdir(REGION_CACHE_DIR):
+            if name.endswith(".json"):
+                os.remove(os.path.join(REGION_CACHE_DIR, name))
+
+
+def layer_key(shp_workspace, shp_store):
+    """
+    Identity of the loaded version of a layer, used to key caches derived from
+    its geometries (e.g. label grids) so they follow boundary changes.
+    """
+    with _layers_lock:
+        fingerprint = _fingerprints.get((shp_workspace, shp_store))
+    return (shp_workspace, shp_store, fingerprint)
+
+
+def simplify_geometries(geometries, tolerance):
+    """Douglas-Peucker simplification, used at about half the raster resolution."""
+    return [mapping(shape(geometry).simplify(tolerance, preserve_topology=True)) for geometry in geometries]
+
+
+def envelope(geometries):
+    """Union bbox (minx, miny, maxx, maxy) of GeoJSON geometries, None if there are none."""
+    if not geometries:
+        return None
+    envelopes = [geometry_bounds(geometry) for geometry in geometries]
+    return (min(b[0] for b in envelopes), min(b[1] for b in envelopes),
+            max(b[2] for b in envelopes), max(b[3] for b in envelopes))
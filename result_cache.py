@@ -0,0 +1,242 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+from metrics import count
+
+
+CREDENTIAL_PARAMS = ("user", "passw")
+
+
+class ResultCache(object):
+    """
+    Cache of computed products (GeoTIFF bytes or JSON bodies) keyed by the
+    endpoint and its normalized parameters.
+
+    The memory tier is an LRU bounded by the size of the stored results, the
+    optional disk tier keeps the encoded result and a JSON metadata file per
+    entry in cache_dir, bounded by total size and evicted by last access. Entries expire after ttl seconds. Every entry
+    carries an ETag derived from its content.
+
+    Results depend on the credentials used to read GeoServer, so they are part
+    of the key unless shared is set, in which case users with access to the
+    same layers share the cached products.
+
+    Keys also carry the data version stored in version_path, which every
+    import bumps, so results computed before an import (including averages
+    cut short by a month that was still missing) are never served after it,
+    by any gunicorn worker of the host.
+    """
+
+    def __init__(self, max_memory_bytes, cache_dir=None, max_disk_bytes=0, ttl=3600, shared=False, version_path=None):
+        self.max_memory_bytes = max_memory_bytes
+        self.cache_dir = cache_dir if max_disk_bytes > 0 else None
+        self.max_disk_bytes = max_disk_bytes
+        self.ttl = ttl
+        self.shared = shared
+        self.version_path = version_path
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        self._lock = threading.Lock()
+        if self.cache_dir:
+            os.makedirs(self.cache_dir, mode=0o700, exist_ok=True)
+        if self.version_path:
+            os.makedirs(os.path.dirname(self.version_path), mode=0o700, exist_ok=True)
+
+    def key(self, name, params):
+        params = {k: v for k, v in params.items() if v is not None}
+        if self.shared:
+            for k in CREDENTIAL_PARAMS:
+                params.pop(k, None)
+        encoded = json.dumps([name, params, self.data_version()], sort_keys=True, separators=(",", ":"), default=str)
+        return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+    def data_version(self):
+        if not self.version_path:
+            return None
+        try:
+            with open(self.version_path) as f:
+                return f.read().strip()
+        except OSError:
+            return None
+
+    def bump_version(self):
+        """Start a new data version, every result computed before is no longer looked up."""
+        if not self.version_path:
+            return
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.version_path), suffix=".part")
+        with os.fdopen(fd, "w") as f:
+            f.write(f"{time.time_ns()}-{os.getpid()}")
+        os.replace(tmp_path, self.version_path)
+
+    def get(self, key):
+        """Stored entry {"value", "etag", "created_at"} for key, None if missing or expired."""
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                self._memory.move_to_end(key)
+        if entry is not None and self._is_fresh(entry):
+            self._count("memory_hit")
+            return entry
+
+        entry = self._disk_get(key)
+        if entry is not None and self._is_fresh(entry):
+            self._count("disk_hit")
+            self._memory_put(key, entry)
+            return entry
+        self._count("miss")
+        return None
+
+    def put(self, key, value):
+        """Store a computed result and return its entry."""
+        content = value if isinstance(value, bytes) else json.dumps(value, sort_keys=True).encode("utf-8")
+        entry = {
+            "value": value,
+            "etag": hashlib.sha256(content).hexdigest()[:32],
+            "created_at": time.time(),
+            "size": len(content),
+        }
+        self._memory_put(key, entry)
+        self._disk_put(key, entry, content)
+        return entry
+
+    def stats(self):
+        with self._lock:
+            stats = {"memory_entries": len(self._memory), "memory_bytes": self._memory_bytes}
+        stats["disk_bytes"] = sum(size for _, size, _ in self._disk_files())
+        return stats
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            self._memory_bytes = 0
+        for path, _, _ in self._disk_files():
+            self._remove(path)
+
+    def _count(self, result):
+        count("aclimate_result_cache_total", {"result": result}, 1, "Result cache lookups by result.")
+
+    def _is_fresh(self, entry):
+        return time.time() - entry["created_at"] < self.ttl
+
+    # Memory tier
+
+    def _memory_put(self, key, entry):
+        if entry["size"] > self.max_memory_bytes:
+            return
+        with self._lock:
+            previous = self._memory.pop(key, None)
+            if previous is not None:
+                self._memory_bytes -= previous["size"]
+            self._memory[key] = entry
+            self._memory_bytes += entry["size"]
+            while self._memory_bytes > self.max_memory_bytes:
+                _, evicted = self._memory.popitem(last=False)
+                self._memory_bytes -= evicted["size"]
+
+    # Disk tier
+
+    def _paths(self, key):
+        base = os.path.join(self.cache_dir, key)
+        return base + ".data", base + ".json"
+
+    def _disk_get(self, key):
+        if not self.cache_dir:
+            return None
+        data_path, meta_path = self._paths(key)
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+            with open(data_path, "rb") as f:
+                content = f.read()
+            os.utime(data_path)
+            value = content if meta["binary"] else json.loads(content)
+        except (OSError, ValueError, KeyError):
+            return None
+        return {"value": value, "etag": meta["etag"], "created_at": meta["created_at"], "size": len(content)}
+
+    def _disk_put(self, key, entry, content):
+        if not self.cache_dir or entry["size"] > self.max_disk_bytes:
+            return
+        data_path, meta_path = self._paths(key)
+        meta = {"etag": entry["etag"], "created_at": entry["created_at"], "binary": isinstance(entry["value"], bytes)}
+        self._write_atomic(data_path, content)
+        self._write_atomic(meta_path, json.dumps(meta).encode("utf-8"))
+        self._evict_disk()
+
+    def _write_atomic(self, path, content):
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".part")
+        with os.fdopen(fd, "wb") as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+
+    def _disk_files(self):
+        if not self.cache_dir:
+            return []
+        files = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(".data"):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            files.append((path, stat.st_size, stat.st_mtime))
+        return files
+
+    def _evict_disk(self):
+        files = sorted(self._disk_files(), key=lambda f: f[2])
+        total = sum(size for _, size, _ in files)
+        for path, size, _ in files:
+            if total <= self.max_disk_bytes:
+                break
+            self._remove(path)
+            total -= size
+
+    def _remove(self, data_path):
+        for path in (data_path, data_path[:-5] + ".json"):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+# Parameters identifying each cached product. The endpoints and the post-import
+# warm-up must build them the same way to share entries.
+
+def subtract_rasters_params(years, month, anomalie, bbox, output, user, passw):
+    return {"years": [int(year) for year in years], "month": int(month), "anomalie": bool(anomalie),
+            "bbox": bbox, "output": output, "user": user, "passw": passw}
+
+
+def global_average_params(workspace, mosaic_name, year, month, bbox, user, passw):
+    return {"workspace": workspace, "mosaic_name": mosaic_name, "year": year, "month": month,
+            "bbox": bbox, "user": user, "passw": passw}
+
+
+def global_average_batch_params(workspace, coverages, dates, bbox, user, passw):
+    return {"workspace": workspace, "coverages": coverages, "dates": dates,
+            "bbox": bbox, "user": user, "passw": passw}
+
+
+def data_region_params(workspace, stores, dates, shp_workspace, shp_store, statistics, simplify, user, passw):
+    return {"workspace": workspace, "stores": stores, "dates": [[int(value) for value in date] for date in dates],
+            "shp_workspace": shp_workspace, "shp_store": shp_store, "statistics": statistics,
+            "simplify": bool(simplify), "user": user, "passw": passw}
+
+
+RESULT_CACHE_DIR = os.environ.get("RESULT_CACHE_DIR", os.path.join(tempfile.gettempdir(), "aclimate_results"))
+
+result_cache = ResultCache(
+    max_memory_bytes=int(os.environ.get("RESULT_CACHE_MEMORY_MB", "128")) * 1024 * 1024,
+    cache_dir=RESULT_CACHE_DIR,
+    max_disk_bytes=int(os.environ.get("RESULT_CACHE_DISK_MB", "0")) * 1024 * 1024,
+    ttl=int(os.environ.get("RESULT_CACHE_TTL", "3600")),
+    shared=os.environ.get("RESULT_CACHE_SHARED", "0") == "1",
+    version_path=os.path.join(RESULT_CACHE_DIR, "version"),
+)
@@ -0,0 +1,88 @@
+import hashlib
+import os
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from metrics import count
+
+
+# Directory of the lock files shared by the gunicorn workers of a host, empty to disable
+SINGLEFLIGHT_LOCK_DIR = os.environ.get("SINGLEFLIGHT_LOCK_DIR", "")
+
+
+class _Call(object):
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """
+    Coalesces concurrent calls with the same key: the first caller runs the
+    function, the others wait for it and get the same result or exception.
+    Nothing is kept once the call finishes, caching is left to the callers.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            count("aclimate_singleflight_total", {"flight": self.name, "role": "follower"}, 1,
+                  "Calls run (leader) or shared (follower) by the single-flight layer.")
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        count("aclimate_singleflight_total", {"flight": self.name, "role": "leader"}, 1,
+              "Calls run (leader) or shared (follower) by the single-flight layer.")
+        try:
+            call.result = fn()
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.done.set()
+
+
+@contextmanager
+def host_lock(key):
+    """
+    Exclusive lock on key between the processes of this host, so that only one
+    gunicorn worker fetches a resource while the others wait and then find it
+    in the shared disk cache. A no-op unless SINGLEFLIGHT_LOCK_DIR is set.
+    """
+    if not SINGLEFLIGHT_LOCK_DIR or fcntl is None:
+        yield
+        return
+    os.makedirs(SINGLEFLIGHT_LOCK_DIR, exist_ok=True)
+    name = hashlib.sha256(repr(key).encode("utf-8")).hexdigest()
+    with open(os.path.join(SINGLEFLIGHT_LOCK_DIR, name + ".lock"), "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+coverage_flight = SingleFlight("wcs")
+region_flight = SingleFlight("wfs")
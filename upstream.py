@@ -0,0 +1,187 @@
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+
+import requests
+
+from metrics import count
+
+
+# Seconds to connect to GeoServer and to wait for each read
+UPSTREAM_CONNECT_TIMEOUT = float(os.environ.get("UPSTREAM_CONNECT_TIMEOUT", "5"))
+UPSTREAM_READ_TIMEOUT = float(os.environ.get("UPSTREAM_READ_TIMEOUT", "120"))
+
+# Retries of a GET after a timeout, a connection error or one of RETRY_STATUS
+UPSTREAM_RETRIES = int(os.environ.get("UPSTREAM_RETRIES", "3"))
+UPSTREAM_BACKOFF = float(os.environ.get("UPSTREAM_BACKOFF", "0.5"))
+UPSTREAM_MAX_BACKOFF = float(os.environ.get("UPSTREAM_MAX_BACKOFF", "10"))
+
+# Bounds and start of the per-host concurrency limit
+UPSTREAM_MIN_CONCURRENCY = int(os.environ.get("UPSTREAM_MIN_CONCURRENCY", "1"))
+UPSTREAM_MAX_CONCURRENCY = int(os.environ.get("UPSTREAM_MAX_CONCURRENCY", "32"))
+UPSTREAM_INITIAL_CONCURRENCY = int(os.environ.get("UPSTREAM_INITIAL_CONCURRENCY", "8"))
+
+# Responses slower than this (until the headers arrive) count as congestion
+UPSTREAM_LATENCY_TARGET = float(os.environ.get("UPSTREAM_LATENCY_TARGET", "5"))
+
+RETRY_STATUS = (429, 502, 503, 504)
+
+
+class UpstreamError(Exception):
+    pass
+
+
+class AIMDLimiter(object):
+    """
+    Concurrency limit of one upstream host, adjusted by additive increase /
+    multiplicative decrease: every good response raises the limit by about one
+    per limit-worth of responses, an error or a response over the latency
+    target halves it, at most once per cooldown so a burst of failures from the
+    same window counts once.
+    """
+
+    def __init__(self, initial, minimum, maximum, latency_target, cooldown=1.0):
+        self.limit = float(max(minimum, min(initial, maximum)))
+        self.minimum = minimum
+        self.maximum = maximum
+        self.latency_target = latency_target
+        self.cooldown = cooldown
+        self.in_flight = 0
+        self.counters = {"successes": 0, "errors": 0, "slow": 0, "waits": 0, "decreases": 0}
+        self._last_decrease = 0.0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        with self._condition:
+            if self.in_flight >= int(self.limit):
+                self.counters["waits"] += 1
+            while self.in_flight >= int(self.limit):
+                self._condition.wait()
+            self.in_flight += 1
+
+    def release(self, latency, ok):
+        with self._condition:
+            self.in_flight -= 1
+            if not ok:
+                self.counters["errors"] += 1
+                self._decrease()
+            elif latency > self.latency_target:
+                self.counters["slow"] += 1
+                self._decrease()
+            else:
+                self.counters["successes"] += 1
+                self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+            self._condition.notify_all()
+
+    def _decrease(self):
+        now = time.monotonic()
+        if now - self._last_decrease < self.cooldown:
+            return
+        self._last_decrease = now
+        self.counters["decreases"] += 1
+        self.limit = max(self.minimum, self.limit / 2)
+
+    def state(self):
+        with self._condition:
+            state = dict(self.counters)
+            state["limit"] = round(self.limit, 2)
+            state["in_flight"] = self.in_flight
+        return state
+
+
+class UpstreamClient(object):
+    """
+    GETs to GeoServer with explicit timeouts, a per-host AIMDLimiter and
+    bounded retries with full-jitter exponential backoff. Only idempotent GETs
+    go through it. Statuses of 400 and above other than the allowed ones raise
+    UpstreamError once the retries are exhausted.
+    """
+
+    def __init__(self, session_factory):
+        self.session_factory = session_factory
+        self._limiters = {}
+        self._lock = threading.Lock()
+
+    def limiter(self, url):
+        host = urlsplit(url).netloc
+        with self._lock:
+            limiter = self._limiters.get(host)
+            if limiter is None:
+                limiter = self._limiters[host] = AIMDLimiter(
+                    UPSTREAM_INITIAL_CONCURRENCY, UPSTREAM_MIN_CONCURRENCY,
+                    UPSTREAM_MAX_CONCURRENCY, UPSTREAM_LATENCY_TARGET)
+        return limiter
+
+    def state(self):
+        with self._lock:
+            limiters = dict(self._limiters)
+        return {host: limiter.state() for host, limiter in limiters.items()}
+
+    def get(self, url, auth=None, headers=None, kind="wcs", allowed=(404,)):
+        """Response with its body already read, the limiter slot covers the download."""
+        with self.stream(url, auth, headers, kind, allowed) as response:
+            response.content
+        return response
+
+    @contextmanager
+    def stream(self, url, auth=None, headers=None, kind="wcs", allowed=(404,)):
+        """
+        Streaming GET, the response is yielded once it is known to be usable and
+        the limiter slot is held until the caller has consumed the body.
+        """
+        limiter = self.limiter(url)
+        attempt = 0
+        while True:
+            limiter.acquire()
+            started = time.perf_counter()
+            response = None
+            try:
+                response = self.session_factory().get(
+                    url, auth=auth, headers=headers, stream=True,
+                    timeout=(UPSTREAM_CONNECT_TIMEOUT, UPSTREAM_READ_TIMEOUT))
+                error = None
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+            latency = time.perf_counter() - started
+            retryable = error is not None or response.status_code in RETRY_STATUS
+
+            if not retryable:
+                ok = True
+                try:
+                    if response.status_code >= 400 and response.status_code not in allowed:
+                        ok = False
+                        raise UpstreamError(f"GeoServer answered {response.status_code} to a {kind.upper()} request")
+                    yield response
+                except (requests.ConnectionError, requests.Timeout):
+                    # The body stopped arriving
+                    ok = False
+                    raise
+                finally:
+                    response.close()
+                    limiter.release(latency, ok)
+                return
+
+            limiter.release(latency, False)
+            if response is not None:
+                response.close()
+            if attempt >= UPSTREAM_RETRIES:
+                count("aclimate_upstream_failures_total", {"kind": kind}, 1,
+                      "Upstream requests that failed after every retry.")
+                if error is not None:
+                    raise UpstreamError(f"{kind.upper()} request failed after {attempt + 1} attempts: {error}")
+                raise UpstreamError(f"GeoServer answered {response.status_code} to a {kind.upper()} request after {attempt + 1} attempts")
+
+            attempt += 1
+            count("aclimate_upstream_retries_total", {"kind": kind}, 1, "Upstream requests retried.")
+            time.sleep(self.backoff(attempt, response))
+
+    def backoff(self, attempt, response=None):
+        """Full jitter exponential backoff, or the Retry-After GeoServer asked for."""
+        if response is not None:
+            retry_after = response.headers.get("Retry-After", "")
+            if retry_after.isdigit():
+                return min(float(retry_after), UPSTREAM_MAX_BACKOFF)
+        return random.uniform(0, min(UPSTREAM_MAX_BACKOFF, UPSTREAM_BACKOFF * 2 ** attempt))
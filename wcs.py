@@ -0,0 +1,151 @@
+import hashlib
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from coverage_cache import coverage_cache
+from metrics import record_upstream, stage
+from singleflight import coverage_flight, host_lock
+from upstream import UPSTREAM_MAX_CONCURRENCY, UpstreamClient
+
+
+URL_ROOT = os.environ.get("GEOSERVER_URL", "https://geo.aclimate.org/geoserver/")
+
+# Axis labels GeoServer uses for the X and Y subsets of the coverages
+WCS_AXIS_LABELS = tuple(os.environ.get("WCS_AXIS_LABELS", "Long,Lat").split(","))
+
+# Upper bound of simultaneous GetCoverage downloads issued by one request
+MAX_DOWNLOAD_WORKERS = int(os.environ.get("MAX_DOWNLOAD_WORKERS", "8"))
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    """Process-wide keep-alive session shared by every WCS/WFS call."""
+    global _session
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=max(MAX_DOWNLOAD_WORKERS, UPSTREAM_MAX_CONCURRENCY, 10))
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _session = session
+    return _session
+
+
+# Timeouts, retries and the adaptive per-host concurrency limit of every GeoServer GET
+upstream = UpstreamClient(get_session)
+
+
+def credential_scope(user, passw):
+    """Opaque id of the GeoServer host and credentials a response was obtained with."""
+    return hashlib.sha256(f"{URL_ROOT}\0{user}\0{passw}".encode("utf-8")).hexdigest()[:16]
+
+
+def coverage_resource(workspace, coverage_id, year, month, bbox=None):
+    """Identity of one time step of a coverage in the coverage cache, bbox as normalize_bbox returns it."""
+    return (workspace, coverage_id, time_subset(year, month), bbox)
+
+
+def time_subset(year, month):
+    return f"Time(\"{int(year):04d}-{int(month):02d}-01T00:00:00.000Z\")"
+
+
+def normalize_bbox(bbox):
+    """(minx, miny, maxx, maxy) as a hashable tuple of floats, None when not given."""
+    if bbox is None:
+        return None
+    minx, miny, maxx, maxy = [float(value) for value in bbox]
+    if minx >= maxx or miny >= maxy:
+        raise ValueError("The bbox must be [minx, miny, maxx, maxy]")
+    return (minx, miny, maxx, maxy)
+
+
+def bbox_subsets(bbox):
+    x_label, y_label = WCS_AXIS_LABELS
+    minx, miny, maxx, maxy = bbox
+    return [f"{x_label}({minx},{maxx})", f"{y_label}({miny},{maxy})"]
+
+
+def build_wcs_url(workspace, coverage_id, year, month, bbox=None):
+    base_url = f"{URL_ROOT}{workspace}/ows?"
+    params = [
+        ("service", "WCS"),
+        ("request", "GetCoverage"),
+        ("version", "2.0.1"),
+        ("coverageId", coverage_id),
+        ("format", "image/geotiff"),
+        ("subset", time_subset(year, month))
+    ]
+    # Only the pixels inside the bbox are downloaded
+    if bbox is not None:
+        params.extend(("subset", subset) for subset in bbox_subsets(bbox))
+    return base_url + urlencode(params)
+
+
+def fetch(url, user, passw, headers=None, kind="wcs"):
+    with stage(kind):
+        response = upstream.get(url, auth=(user, passw), headers=headers, kind=kind)
+        record_upstream(kind, response.status_code, len(response.content))
+    return response
+
+
+def get_coverage(workspace, coverage_id, year, month, user, passw, bbox=None):
+    """
+    Decoded Coverage for one time step through the coverage cache, None on 404.
+    Concurrent misses for the same coverage share one download and decode.
+    Cached copies are only served to the credentials that fetched them.
+    """
+    bbox = normalize_bbox(bbox)
+    key = (credential_scope(user, passw), coverage_resource(workspace, coverage_id, year, month, bbox))
+    coverage = coverage_cache.peek(key)
+    if coverage is not None:
+        return coverage
+
+    url = build_wcs_url(workspace, coverage_id, year, month, bbox)
+
+    def load():
+        with host_lock(key):
+            return coverage_cache.get(key, url, lambda url, headers: fetch(url, user, passw, headers))
+    # Only callers with the same credentials share a download, and its errors
+    return coverage_flight.do(key, load)
+
+
+def spool_coverage(workspace, coverage_id, year, month, user, passw, directory, bbox=None):
+    """
+    Path of a GeoTIFF file for one time step, None on 404. The response is
+    streamed to directory without being decoded; a fresh copy in the disk
+    tier of the coverage cache is linked into directory instead.
+    """
+    bbox = normalize_bbox(bbox)
+    key = (credential_scope(user, passw), coverage_resource(workspace, coverage_id, year, month, bbox))
+    path = os.path.join(directory, f"{workspace}_{coverage_id}_{int(year):04d}{int(month):02d}.tif")
+    if coverage_cache.cached_file(key, path):
+        return path
+
+    url = build_wcs_url(workspace, coverage_id, year, month, bbox)
+    nbytes = 0
+    with stage("wcs"):
+        with upstream.stream(url, auth=(user, passw), kind="wcs") as response:
+            if response.status_code == 404:
+                record_upstream("wcs", response.status_code, 0)
+                return None
+            with open(path, "wb") as f:
+                for chunk in response.iter_content(chunk_size=1024 * 1024):
+                    f.write(chunk)
+                    nbytes += len(chunk)
+        record_upstream("wcs", response.status_code, nbytes)
+    return path
+
+
+def download_pool(max_workers=None):
+    """Thread pool for concurrent downloads, capped by MAX_DOWNLOAD_WORKERS."""
+    workers = MAX_DOWNLOAD_WORKERS
+    if max_workers:
+        workers = max(1, min(int(max_workers), MAX_DOWNLOAD_WORKERS))
+    return ThreadPoolExecutor(max_workers=workers)
@@ -0,0 +1,81 @@
+import os
+from contextlib import ExitStack
+
+import numpy as np
+import rasterio
+from rasterio.windows import Window
+
+from accumulator import NODATA, RasterAccumulator
+from raster_output import add_overviews, cast_output, copy_to_cog, geotiff_profile
+
+
+# Rows and columns read per block, rounded to the output tile size
+WINDOWED_BLOCK_SIZE = int(os.environ.get("WINDOWED_BLOCK_SIZE", "1024"))
+
+# Process every request block by block unless the payload says otherwise
+WINDOWED_DEFAULT = os.environ.get("WINDOWED_PROCESSING", "0") == "1"
+
+
+def block_windows(width, height, block):
+    for row in range(0, height, block):
+        for col in range(0, width, block):
+            yield Window(col, row, min(block, width - col), min(block, height - row))
+
+
+def _block_size(options):
+    tile = options["blocksize"]
+    return max(tile, WINDOWED_BLOCK_SIZE // tile * tile)
+
+
+def windowed_average(paths, output_path, options, climatology_path=None, anomaly=None):
+    """
+    Average the rasters in paths block by block and write each block to
+    output_path as it is computed. With a climatology, anomaly(average,
+    climatology) is applied to every block. Peak memory is a few blocks,
+    whatever the raster size. Returns the output profile.
+    """
+    with ExitStack() as stack:
+        datasets = [stack.enter_context(rasterio.open(path)) for path in paths]
+        climatology = stack.enter_context(rasterio.open(climatology_path)) if climatology_path else None
+        first = datasets[0]
+        profile = geotiff_profile(first.width, first.height, options["dtype"], first.crs, first.transform, NODATA, options)
+
+        with rasterio.open(output_path, "w", **profile) as dst:
+            for window in block_windows(first.width, first.height, _block_size(options)):
+                accumulator = RasterAccumulator()
+                for dataset in datasets:
+                    accumulator.add(dataset.read(1, window=window), dataset.nodata)
+                result = accumulator.mean()
+                if climatology is not None:
+                    result = anomaly(result, climatology.read(1, window=window))
+                dst.write(cast_output(result, options["dtype"]), 1, window=window)
+            add_overviews(dst, options)
+    return profile
+
+
+def windowed_mean(path, block=None):
+    """Mean of the valid pixels of a raster file, reading one block at a time."""
+    total = 0.0
+    count = 0
+    with rasterio.open(path) as dataset:
+        nodata = NODATA if dataset.nodata is None else dataset.nodata
+        for window in block_windows(dataset.width, dataset.height, block or WINDOWED_BLOCK_SIZE):
+            data = dataset.read(1, window=window)
+            valid = data != nodata
+            if np.issubdtype(data.dtype, np.floating):
+                valid &= ~np.isnan(data)
+            total += float(data.sum(where=valid, dtype=np.float64))
+            count += int(np.count_nonzero(valid))
+    if count == 0:
+        return None
+    return total / count
+
+
+def read_output(path, profile, options):
+    """Bytes of a GeoTIFF written by windowed_average, converted to COG if requested."""
+    if options["cog"]:
+        cog_path = path + ".cog.tif"
+        copy_to_cog(path, cog_path, profile, options)
+        path = cog_path
+    with open(path, "rb") as f:
+        return f.read()
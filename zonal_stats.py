@@ -0,0 +1,151 @@
+import hashlib
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from rasterio.features import rasterize
+
+from metrics import stage
+from regions import simplify_geometries
+
+
+STATISTICS = ("count", "mean", "min", "max", "std", "sum")
+
+LABEL_CACHE_SIZE = 32
+
+# Label grids are also kept on disk, empty to disable
+LABEL_CACHE_DIR = os.environ.get("LABEL_CACHE_DIR", os.path.join(tempfile.gettempdir(), "aclimate_label_grids"))
+
+_label_grids = OrderedDict()
+_label_lock = threading.Lock()
+
+
+def grid_key(profile):
+    return (tuple(profile["transform"])[:6], (profile["height"], profile["width"]))
+
+
+def label_grid(geometries, transform, shape):
+    """
+    Burn the geometries into a grid aligned with the coverage where each pixel
+    holds the 1-based index of the geometry containing its center, 0 outside.
+    Regions are expected not to overlap; on overlaps the last geometry wins.
+    """
+    shapes = [(geometry, i) for i, geometry in enumerate(geometries, start=1)]
+    if not shapes:
+        return np.zeros(shape, dtype=np.int32)
+    return rasterize(shapes, out_shape=shape, transform=transform, fill=0, dtype="int32")
+
+
+def _disk_path(key):
+    name = hashlib.sha256(repr(key).encode("utf-8")).hexdigest()
+    return os.path.join(LABEL_CACHE_DIR, name + ".npy")
+
+
+def get_label_grid(layer_key, geometries, profile, simplify=False):
+    """
+    Label grid for a region layer on a coverage grid, cached per (layer, grid)
+    in memory and in LABEL_CACHE_DIR. With simplify the geometries are
+    simplified to half a pixel before burning them.
+    """
+    key = (layer_key, grid_key(profile), bool(simplify))
+    with _label_lock:
+        labels = _label_grids.get(key)
+        if labels is not None:
+            _label_grids.move_to_end(key)
+            return labels
+
+    labels = None
+    if LABEL_CACHE_DIR:
+        try:
+            labels = np.load(_disk_path(key))
+        except (OSError, ValueError):
+            labels = None
+    if labels is None:
+        if simplify:
+            transform = profile["transform"]
+            geometries = simplify_geometries(geometries, min(abs(transform.a), abs(transform.e)) / 2)
+        with stage("rasterize"):
+            labels = label_grid(geometries, profile["transform"], (profile["height"], profile["width"]))
+        if LABEL_CACHE_DIR:
+            os.makedirs(LABEL_CACHE_DIR, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=LABEL_CACHE_DIR, suffix=".npy")
+            with os.fdopen(fd, "wb") as f:
+                np.save(f, labels)
+            os.replace(tmp_path, _disk_path(key))
+    labels.setflags(write=False)
+    with _label_lock:
+        _label_grids[key] = labels
+        while len(_label_grids) > LABEL_CACHE_SIZE:
+            _label_grids.popitem(last=False)
+    return labels
+
+
+def clear_label_grids():
+    """Forget every label grid, in memory and in LABEL_CACHE_DIR."""
+    with _label_lock:
+        _label_grids.clear()
+    if LABEL_CACHE_DIR and os.path.isdir(LABEL_CACHE_DIR):
+        for name in os.listdir(LABEL_CACHE_DIR):
+            if name.endswith(".npy"):
+                os.remove(os.path.join(LABEL_CACHE_DIR, name))
+
+
+def zonal_stats(values, labels, zones, statistics=("mean",), nodata=None):
+    """
+    Compute the requested statistics for zones 1..zones in one pass over the
+    pixels. NaN pixels and pixels equal to nodata are skipped; without nodata
+    every negative pixel is, as /api/data_region always did. Returns one dict
+    per zone; statistics of empty zones are None, except count which is 0.
+    """
+    with stage("zonal_stats"):
+        return _zonal_stats(values, labels, zones, statistics, nodata)
+
+
+def _zonal_stats(values, labels, zones, statistics, nodata):
+    valid = labels > 0
+    if np.issubdtype(values.dtype, np.floating):
+        valid &= ~np.isnan(values)
+    if nodata is None:
+        valid &= values >= 0
+    else:
+        valid &= values != nodata
+
+    zone_ids = labels[valid]
+    data = values[valid].astype(np.float64)
+
+    count = np.bincount(zone_ids, minlength=zones + 1)[1:zones + 1]
+    computed = {"count": count}
+    with np.errstate(invalid="ignore", divide="ignore"):
+        if {"sum", "mean", "std"} & set(statistics):
+            total = np.bincount(zone_ids, weights=data, minlength=zones + 1)[1:zones + 1]
+            computed["sum"] = total
+            computed["mean"] = total / count
+        if "std" in statistics:
+            squares = np.bincount(zone_ids, weights=data * data, minlength=zones + 1)[1:zones + 1]
+            computed["std"] = np.sqrt(np.maximum(squares / count - computed["mean"] ** 2, 0))
+    if {"min", "max"} & set(statistics):
+        computed["min"] = np.full(zones, np.nan)
+        computed["max"] = np.full(zones, np.nan)
+        if data.size:
+            order = np.argsort(zone_ids, kind="stable")
+            sorted_zones = zone_ids[order]
+            sorted_data = data[order]
+            starts = np.flatnonzero(np.r_[True, sorted_zones[1:] != sorted_zones[:-1]])
+            present = sorted_zones[starts] - 1
+            computed["min"][present] = np.minimum.reduceat(sorted_data, starts)
+            computed["max"][present] = np.maximum.reduceat(sorted_data, starts)
+
+    results = []
+    for zone in range(zones):
+        zone_stats = {}
+        for stat in statistics:
+            if stat == "count":
+                zone_stats[stat] = int(count[zone])
+            elif count[zone] == 0:
+                zone_stats[stat] = None
+            else:
+                zone_stats[stat] = float(computed[stat][zone])
+        results.append(zone_stats)
+    return results